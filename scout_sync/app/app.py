@@ -1,25 +1,87 @@
-import sys
+import os
+import re
+import gzip
+import hmac
+import hashlib
 import logging
-import arrow
-from flask import Flask, request, abort, render_template
+import threading
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, request, abort, render_template, send_from_directory
 from markupsafe import Markup, escape
-from apscheduler.schedulers.background import BackgroundScheduler
-from ..config import config
-from ..sync import sync, Event, WebCacheHandler
+from ..config import config, load_config
+from ..log import setup_logging_from_config
+from ..sync import sync_job, Event, WebCacheHandler, ArchiveHandler, CacheConflictError
+from ..sync import profiling, calendar_watch, lookup
+from ..worker import SyncQueue
+from .ical import to_ical
 
-logging.basicConfig(
-    filename=config.get('COMMON', 'log_file'),
-        format='%(asctime)s %(levelname)s: %(message)s',
-        datefmt='%Y-%m-%dT%H:%M:%S',
-        level=logging.INFO)
+__scheduler = None
+__scheduler_lock = threading.Lock()
 
-logging.getLogger('werkzeug').setLevel(logging.ERROR)
-logging.getLogger('apscheduler').setLevel(logging.ERROR)
-sys.excepthook = lambda exc_type, exc_value, exc_traceback: logging.exception(
-    exc_type.__name__, exc_info=(exc_type, exc_value, exc_traceback))
+# calendar syncs requested by notifications: a notification during a run requests one more run
+__calendar_sync_lock = threading.Lock()
+__calendar_sync_requested = False
+__calendar_sync_running = False
 
-scheduler = BackgroundScheduler(timzone=config.get('COMMON', 'timezone'))
-scheduler.start()
+# events of the archived seasons: season -> events
+__archived_events = {}
+
+# generated iCalendar feeds of the current cache version: (scouters, leagues) -> feed
+__ICAL_MAX_FEEDS = 64
+__ical_feeds = {}
+__ical_version = None
+__ical_lock = threading.Lock()
+
+def get_scheduler():
+    """return the background scheduler, it is created and started on first use"""
+
+    global __scheduler
+    with __scheduler_lock:
+        if __scheduler is None:
+            from apscheduler.schedulers.background import BackgroundScheduler
+
+            __scheduler = BackgroundScheduler(timezone=config.get('COMMON', 'timezone'))
+            __scheduler.start()
+
+    return __scheduler
+
+def sync_worker_enabled():
+    return config.getboolean('SYNC_WORKER', 'enabled', fallback=False)
+
+def request_sync(source):
+    """hand the sync to the sync worker process or run it in the scheduler of this process
+    calendar notifications come in bursts, they share one job that runs again if requested during a run"""
+
+    global __calendar_sync_requested, __calendar_sync_running
+    if sync_worker_enabled():
+        SyncQueue(config.get('SYNC_WORKER', 'queue_file')).put(source)
+    elif source == 'calendar':
+        with __calendar_sync_lock:
+            __calendar_sync_requested = True
+            if __calendar_sync_running:
+                return
+            __calendar_sync_running = True
+
+        get_scheduler().add_job(calendar_sync_job)
+    else:
+        get_scheduler().add_job(sync_job, kwargs={'source': source})
+
+def calendar_sync_job():
+    """run the calendar sync until no notification arrived during the last run"""
+
+    global __calendar_sync_requested, __calendar_sync_running
+    while True:
+        with __calendar_sync_lock:
+            if not __calendar_sync_requested:
+                __calendar_sync_running = False
+                return
+            __calendar_sync_requested = False
+
+        try:
+            sync_job('calendar')
+        except Exception as e:
+            # the next requested run starts from the same sync token
+            logging.exception(e)
 
 def escape_json(j):
     if isinstance(j, str):
@@ -62,7 +124,9 @@ def edit():
     """POST access point for edits from webpage
     
     Request data should be:
-    {password: password, events: [json_events]}"""
+    {password: password, events: [json_events]}
+    If the If-Match header contains the ETag of the cache version the edits are based on,
+    the request fails with 409 if the cache has been changed since."""
 
     logging.info(f'Edit request from {request.access_route[0]}')
 
@@ -86,12 +150,30 @@ def edit():
         logging.exception(e)
         abort(400)
 
-    WebCacheHandler(config.get('COMMON', 'web_cache_file')).store_events(event_list)
+    try:
+        version = WebCacheHandler(config.get('COMMON', 'web_cache_file')).store_events(
+            event_list, expected_version=expected_cache_version())
+    except CacheConflictError as e:
+        logging.info(f'Edit rejected: {e}')
+        abort(409, description='The events have been changed in the meantime.')
+
     logging.info(f'Events cache updated from webpage.')
 
-    scheduler.add_job(sync, kwargs={'source': 'cache'})
+    request_sync('cache')
+
+    return {'version': version}, 201, {'ETag': cache_etag(version)}
+
+def cache_etag(version):
+    return f'"v{version}"'
+
+def expected_cache_version():
+    """return the cache version from the If-Match header, None if there is none"""
 
-    return {}, 201
+    for etag in request.if_match.as_set():
+        if re.fullmatch(r'v\d+', etag):
+            return int(etag[1:])
+
+    return None
 
 
 @app.route('/list')
@@ -103,7 +185,7 @@ def _list():
     return render_template(
         'list.html',
         title=config.get('COMMON', 'title'),
-        names=sorted(list(config['EMAILS'].keys())))
+        names=lookup.refresh().scouters)
 
 @app.route('/list/events')
 def events():
@@ -113,9 +195,8 @@ def events():
     logging.info(f'Events update request from {request.access_route[0]}')
 
     try:
-        events =  escape_json(
-            WebCacheHandler(config.get('COMMON', 'web_cache_file')).json_events()
-        )
+        cache_hdl = WebCacheHandler(config.get('COMMON', 'web_cache_file'))
+        events =  escape_json(cache_hdl.json_events())
     except Exception as e:
         logging.exception(e)
         abort(400)
@@ -123,25 +204,198 @@ def events():
     if events is None:
         abort(500, description='Events have not been cached yet.')
 
+    return events, {'ETag': cache_etag(cache_hdl.version)}
+
+@app.route('/list/archive')
+def archive():
+    """GET access point for the list of archived seasons"""
+
+    return ArchiveHandler(config.get('COMMON', 'archive_dir')).seasons()
+
+@app.route('/list/archive/<season>')
+def archived_events(season):
+    """GET access point for the events of an archived season
+    Returns the archived events in JSON format"""
+
+    logging.info(f'Archive request for season {season} from {request.access_route[0]}')
+
+    events = archived_season_events(season)
+    if events is None:
+        abort(404)
+
     return events
 
+def archived_season_events(season):
+    """return the escaped events of an archived season
+    the archives are read-only, so each season is only read once"""
+
+    if re.fullmatch(r'\d{4}-\d{2}', season) is None:
+        return None
+
+    events = __archived_events.get(season)
+    if events is None:
+        events = ArchiveHandler(config.get('COMMON', 'archive_dir')).json_events(season)
+        if events is not None:
+            events = __archived_events.setdefault(season, escape_json(events))
+
+    return events
+
+@app.route('/list/events.ics')
+def events_ical():
+    """GET access point for the events as iCalendar feed
+    The feed can be filtered with the query parameters 'scouter' and 'league' (both repeatable).
+    Each variant is generated once per cache version and kept in memory."""
+
+    logging.info(f'iCalendar request from {request.access_route[0]}')
+
+    try:
+        stat = os.stat(config.get('COMMON', 'web_cache_file'))
+    except FileNotFoundError:
+        abort(500, description='Events have not been cached yet.')
+
+    scouters = tuple(sorted(set(request.args.getlist('scouter'))))
+    leagues = tuple(sorted(set(request.args.getlist('league'))))
+    body, gzip_body, etag, last_modified = ical_feed((stat.st_mtime_ns, stat.st_size), scouters, leagues)
+
+    use_gzip = 'gzip' in request.accept_encodings
+    response = Response(gzip_body if use_gzip else body, mimetype='text/calendar')
+    response.set_etag(f'{etag}-gz' if use_gzip else etag)
+    response.last_modified = last_modified
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    if use_gzip:
+        response.content_encoding = 'gzip'
+
+    return response.make_conditional(request)
+
+def ical_feed(version, scouters, leagues):
+    """return the (body, gzipped body, etag, last modified) of the feed variant for the cache version"""
+
+    global __ical_version
+    key = (scouters, leagues)
+    with __ical_lock:
+        if __ical_version != version:
+            __ical_feeds.clear()
+            __ical_version = version
+
+        feed = __ical_feeds.get(key)
+        if feed is not None:
+            return feed
+
+    event_list = WebCacheHandler(config.get('COMMON', 'web_cache_file')).list_events()
+    if event_list is None:
+        abort(500, description='Events have not been cached yet.')
+
+    event_list = [
+        ev for ev in event_list
+        if (not scouters or any(s in scouters for s in ev.scouters or [])) and
+        (not leagues or ev.league in leagues)]
+    last_modified = datetime.fromtimestamp(version[0] / 1e9, timezone.utc).replace(microsecond=0)
+    body = to_ical(event_list, config.get('COMMON', 'title'), last_modified).encode('utf8')
+    feed = (body, gzip.compress(body), hashlib.sha1(body).hexdigest(), last_modified)
+
+    with __ical_lock:
+        if __ical_version == version:
+            if len(__ical_feeds) >= __ICAL_MAX_FEEDS:
+                __ical_feeds.pop(next(iter(__ical_feeds)))
+            __ical_feeds[key] = feed
+
+    return feed
+
+@app.post('/calendar/notifications')
+def calendar_notification():
+    """POST access point for the push notifications of the Google Calendar
+    Notifications of changed events trigger an incremental sync from the calendar"""
+
+    if not calendar_watch.watch_enabled():
+        abort(404)
+
+    channel_id = request.headers.get('X-Goog-Channel-ID', '')
+    state = request.headers.get('X-Goog-Resource-State', '')
+    if not calendar_watch.valid_notification(channel_id, request.headers.get('X-Goog-Channel-Token', '')):
+        logging.warning(f'Invalid calendar notification from {request.access_route[0]}')
+        abort(403)
+
+    logging.debug(
+        f'Calendar notification: {state}',
+        extra={'data': {'channel': channel_id, 'message': request.headers.get('X-Goog-Message-Number')}})
+
+    # 'sync' is only sent when the channel is registered
+    if state == 'exists':
+        request_sync('calendar')
+
+    return '', 204
+
+def check_admin_auth():
+    """abort with 401 if the request has no valid admin credentials (HTTP basic auth)"""
+
+    pw = config.get('COMMON', 'admin_pw')
+    auth = request.authorization
+    if pw == '' or auth is None or not hmac.compare_digest((auth.password or '').encode(), pw.encode()):
+        abort(Response('', 401, {'WWW-Authenticate': 'Basic realm="scout-sync admin"'}))
+
+@app.route('/admin/profiles')
+def profiles():
+    """GET access point for the list of sync profiles
+    Returns a list of {name, size, modified} in JSON format, newest first"""
+
+    check_admin_auth()
+    logging.info(f'Profile list request from {request.access_route[0]}')
+
+    return [
+        {'name': name, 'size': size, 'modified': modified}
+        for name, size, modified in profiling.list_profiles(config.get('PROFILING', 'profile_dir'))]
+
+@app.route('/admin/profiles/<name>')
+def profile(name):
+    """GET access point for downloading a sync profile"""
+
+    check_admin_auth()
+    logging.info(f'Profile download request for {name} from {request.access_route[0]}')
+
+    if not profiling.is_profile_file(name):
+        abort(404)
+
+    return send_from_directory(
+        os.path.abspath(config.get('PROFILING', 'profile_dir')), name, as_attachment=True)
+
 def start_sync_job():
-    """start a scheduler with the calendar syncronisation job defined in the SYNC_JOB config section"""
+    """start a scheduler with the calendar syncronisation job defined in the SYNC_JOB config section
+    and the renewal of the calendar notification channel
+    the jobs are not started if the syncs run in the sync worker process"""
+
+    if sync_worker_enabled():
+        return
+
+    if calendar_watch.watch_enabled():
+        get_scheduler().add_job(
+            calendar_watch.renew_watch,
+            'interval',
+            hours=1,
+            start_date=datetime.now(timezone.utc) + timedelta(seconds=5))
 
     if not 'SYNC_JOB' in config:
         return
     
-    interval = config.getint('SYNC_JOB', 'interval')
+    interval = calendar_watch.sync_job_interval()
 
-    scheduler.add_job(
-        sync,
+    get_scheduler().add_job(
+        sync_job,
         'interval',
         kwargs={'source': 'schedule'},
         minutes=interval,
-        start_date=arrow.get().shift(seconds=10).datetime)
+        start_date=datetime.now(timezone.utc) + timedelta(seconds=10))
+
+def setup():
+    """read the config and set up logging"""
+
+    load_config()
+    setup_logging_from_config(config)
 
 def app_startup():
     """app factory method launch function"""
 
+    setup()
     start_sync_job()
     return app
@@ -0,0 +1,83 @@
+"""iCalendar (RFC 5545) export of the event list"""
+
+from datetime import timedelta, timezone
+
+__EVENT_DURATION = timedelta(hours=2)
+
+
+def _escape(text):
+    return (
+        text.replace('\\', '\\\\')
+        .replace(';', '\\;')
+        .replace(',', '\\,')
+        .replace('\r\n', '\\n')
+        .replace('\n', '\\n'))
+
+
+def _fold(line):
+    """split a content line into lines of at most 75 octets"""
+    encoded = line.encode('utf8')
+    if len(encoded) <= 75:
+        return line
+
+    parts = []
+    start = 0
+    limit = 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # do not split multi-byte characters
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode('utf8'))
+        start = end
+        limit = 74
+
+    return '\r\n '.join(parts)
+
+
+def _utc(dt):
+    return dt.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def to_ical(events, title, modified):
+    """Create an iCalendar document from a list of events
+    events -> list of Event objects
+    title -> string calendar name
+    modified -> datetime of the last change of the events
+    Returns the document as string"""
+
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//scout-sync//events//DE',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{_escape(title)}']
+
+    stamp = _utc(modified)
+    for ev in events:
+        if not ev.datetime:
+            continue
+
+        start = ev.datetime
+        description = [ev.opponent or '']
+        if ev.scouters:
+            description.append(f"Scouter: {', '.join(ev.scouters)}")
+        description = '\n'.join(description).strip()
+
+        lines.extend([
+            'BEGIN:VEVENT',
+            f'UID:{_escape(ev.id)}@scout-sync',
+            f'DTSTAMP:{stamp}',
+            f'DTSTART:{_utc(start)}',
+            f'DTEND:{_utc(start + __EVENT_DURATION)}',
+            f"SUMMARY:{_escape('Scouting ' + (ev.league or ''))}"])
+        if ev.location:
+            lines.append(f'LOCATION:{_escape(ev.location)}')
+        lines.extend([
+            f'DESCRIPTION:{_escape(description)}',
+            'END:VEVENT'])
+
+    lines.append('END:VCALENDAR')
+
+    return ''.join(_fold(line) + '\r\n' for line in lines)
@@ -1,4 +1,7 @@
 EVENTS = []
+CACHE_VERSION = null
+// cache version of the events in the edit table, the edits are submitted against it
+EDIT_VERSION = null
 
 function addViewTableRow(event) {
     const date = new Date(event.datetime)
@@ -91,11 +94,12 @@ function addEditTableRow(event) {
 }
 
 function reloadEvents () {
-    $.getJSON('/list/events', (response, status) => {  
+    $.getJSON('/list/events', (response, status, xhr) => {  
         if (status != 'success') {
             throw new Error(status)
         }
         
+        CACHE_VERSION = xhr.getResponseHeader('ETag')
         EVENTS = response.sort((e1, e2) => new Date(e1.datetime) - new Date(e2.datetime))
 
         $('#viewEventTable').children('tr').not('.templateRow').remove()
@@ -110,8 +114,41 @@ function reloadEvents () {
     })
 }
 
+function loadSeasons () {
+    $.getJSON('/list/archive', (response, status) => {
+        if (status != 'success') {
+            throw new Error(status)
+        }
+
+        response.forEach(season => $('#seasonSelect').append(
+            $('<option>').val(season).text(season.replace('-', '/'))
+        ))
+    })
+}
+
+function loadSeason () {
+    const season = $('#seasonSelect').val()
+    $('#editToggle').prop('disabled', season !== '')
+    if (season === '') {
+        reloadEvents()
+        return
+    }
+
+    $.getJSON(`/list/archive/${encodeURIComponent(season)}`, (response, status) => {
+        if (status != 'success') {
+            throw new Error(status)
+        }
+
+        $('#viewEventTable').children('tr').not('.templateRow').remove()
+        response
+            .sort((e1, e2) => new Date(e1.datetime) - new Date(e2.datetime))
+            .forEach(addViewTableRow)
+    })
+}
+
 function updateEditTable () {
     $('#editEventTable').children('tr').not('.templateRow').remove()
+    EDIT_VERSION = CACHE_VERSION
     EVENTS.forEach(addEditTableRow)
 }
 
@@ -139,7 +176,8 @@ function submitEvents() {
         {
             method: 'POST',
             data: JSON.stringify({ password: $('#pwInput').val(), events: tableData }),
-            contentType: 'application/json'
+            contentType: 'application/json',
+            headers: EDIT_VERSION ? {'If-Match': EDIT_VERSION} : {}
         }
     )
     .done(() => {
@@ -150,6 +188,10 @@ function submitEvents() {
     })
     .fail((data) => {
             if (data.status == 401) $('#submitResponse').text('Passwort falsch')
+            else if (data.status == 409) {
+                $('#submitResponse').text('Die Liste wurde zwischenzeitlich geändert, bitte neu laden')
+                reloadEvents()
+            }
             else $('#submitResponse').text(`${data.status}: ${data.statusText}`)
             $('#pwInput').val('')
         }
@@ -231,10 +273,12 @@ $(document).ready(() => {
         setEditState()
     })
     $('#statsToggle').on('change', setStatsState)
+    $('#seasonSelect').val('').on('change', loadSeason)
 
+    loadSeasons()
     reloadEvents()
 })
 
 $(window).on("focus", () => {
-        reloadEvents()
+        if ($('#seasonSelect').val() === '') reloadEvents()
 })
\ No newline at end of file
@@ -0,0 +1,3 @@
+"""Benchmarks for the app and the sync
+
+The benchmarks are run as modules, e.g. `python -m scout_sync.bench.importtime`"""
@@ -0,0 +1,63 @@
+"""Per event cost of the date and time handling in the sync hot loops
+
+Compares the previous arrow based implementation (if arrow is installed) with the
+standard library implementation in scout_sync.sync.dates for the operations done
+for each event: parsing the calendar start time, getting the current time,
+creating the datetime of a DBB schedule match and formatting start and end time."""
+
+import timeit
+from datetime import timedelta
+from argparse import ArgumentParser
+from ..sync import dates
+
+TIMEZONE = 'Europe/Berlin'
+CALENDAR_DATETIME = '2025-02-01T19:30:00+01:00'
+KICKOFF_DATE = '2025-02-01'
+KICKOFF_TIME = '19:30'
+
+
+def current_event():
+    run_now = dates.now(TIMEZONE)
+
+    def run():
+        start = dates.parse_iso(CALENDAR_DATETIME)
+        now = run_now
+        kickoff = dates.parse_local(f"{KICKOFF_DATE}T{KICKOFF_TIME}", TIMEZONE)
+        kickoff.isoformat()
+        (kickoff + timedelta(hours=2)).isoformat()
+        return start > now
+
+    return run
+
+
+def arrow_event():
+    import arrow
+
+    def run():
+        start = arrow.get(CALENDAR_DATETIME)
+        now = arrow.now(TIMEZONE)
+        kickoff = arrow.get(f"{KICKOFF_DATE}T{KICKOFF_TIME}", tzinfo=TIMEZONE)
+        kickoff.isoformat()
+        kickoff.shift(hours=2).isoformat()
+        return start > now
+
+    return run
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--events', type=int, default=10000, help='number of events per repetition')
+    parser.add_argument('--repeat', type=int, default=5)
+
+    ARGS = parser.parse_args()
+
+    implementations = {'zoneinfo': current_event}
+    try:
+        import arrow
+        implementations['arrow'] = arrow_event
+    except ImportError:
+        print('arrow is not installed, only the current implementation is measured')
+
+    for name, implementation in implementations.items():
+        best = min(timeit.repeat(implementation(), number=ARGS.events, repeat=ARGS.repeat))
+        print(f"{name:>10}: {best / ARGS.events * 1e6:.2f}us per event")
@@ -0,0 +1,84 @@
+"""Import time benchmark for the sync command line interface and the gunicorn worker boot
+
+Runs the entry point in a fresh interpreter with `-X importtime` and reports the modules
+with the highest cumulative import time.
+Exits with status 1 if the total import time exceeds the budget or if a module was imported
+that should only be loaded lazily on the code paths that use it."""
+
+import os
+import re
+import sys
+import subprocess
+from argparse import ArgumentParser
+
+# target -> (interpreter arguments, modules that must not be imported on startup)
+TARGETS = {
+    'cli': (
+        ['-m', 'scout_sync.sync'],
+        ['googleapiclient', 'google_auth_oauthlib', 'requests', 'flask', 'apscheduler']),
+    'web': (
+        ['-c', 'import scout_sync.app'],
+        ['googleapiclient', 'google_auth_oauthlib', 'requests', 'apscheduler']),
+}
+
+__LINE_PATTERN = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+
+def measure(target):
+    """Run the target with `-X importtime`
+    Returns a list of (module name, self time [us], cumulative time [us], nesting level)"""
+
+    args, _ = TARGETS[target]
+    root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', *args],
+        cwd=root_dir,
+        capture_output=True,
+        text=True)
+
+    if result.returncode != 0:
+        raise RuntimeError(f"Import of '{target}' failed:\n{result.stderr.splitlines()[-1]}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = __LINE_PATTERN.match(line)
+        if match is None:
+            continue
+
+        self_us, cumulative_us, indent, module = match.groups()
+        imports.append((module, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+
+    return imports
+
+
+def report(target, budget_ms, top):
+    """Print the import time report for the target
+    Returns True if the target stays within the budget and imports no forbidden modules"""
+
+    _, forbidden = TARGETS[target]
+    imports = measure(target)
+    total_ms = sum(cumulative for _, _, cumulative, level in imports if level == 0) / 1000
+    loaded = {module.split('.')[0] for module, _, _, _ in imports}
+    eager = sorted(loaded.intersection(forbidden))
+
+    print(f"Import time for '{target}': {total_ms:.1f}ms (budget {budget_ms:.0f}ms)")
+    print(f"{'cumulative [ms]':>16} {'self [ms]':>10}  module")
+    for module, self_us, cumulative_us, level in sorted(imports, key=lambda i: -i[2])[:top]:
+        print(f"{cumulative_us / 1000:>16.1f} {self_us / 1000:>10.1f}  {'  ' * level}{module}")
+
+    if eager:
+        print(f"Eagerly imported: {', '.join(eager)}")
+
+    return total_ms <= budget_ms and not eager
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--target', choices=list(TARGETS), action='append')
+    parser.add_argument('--budget', type=float, default=300, help='import time budget in ms')
+    parser.add_argument('--top', type=int, default=15)
+
+    ARGS = parser.parse_args()
+
+    ok = all([report(t, ARGS.budget, ARGS.top) for t in ARGS.target or TARGETS])
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,209 @@
+"""Load test for the web endpoints
+
+Starts the app with the stubbed Google and DBB backends (see scout_sync.bench.stubs) against a
+synthetic events cache in a temporary directory, runs concurrent readers of /list/events and
+/list/events.ics and editors submitting to /list/edit at fixed rates, and reports throughput,
+latency percentiles and errors per endpoint.
+Every edit triggers a sync from the cache, additional syncs from the schedule can be scheduled
+with --sync-interval. With --watch the in-memory calendar posts change notifications to the app,
+which trigger incremental syncs from the calendar.
+
+usage: python -m scout_sync.bench.loadtest [--duration 30] [--readers 8] [--editors 1] ..."""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from argparse import ArgumentParser
+from .stubs import synthetic_events, SCOUTERS
+
+PASSWORD = 'loadtest'
+
+
+def start_server(work_dir, port, server, workers, threads, stub_latency, sync_interval, watch):
+    """Start the app with the stubbed backends in a subprocess"""
+
+    root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([root_dir, os.environ.get('PYTHONPATH', '')]),
+        SUBMIT_PW=PASSWORD,
+        SCOUT_SYNC_STUB_LATENCY=str(stub_latency),
+        SCOUT_SYNC_STUB_SYNC_INTERVAL=str(sync_interval),
+        SCOUT_SYNC_STUB_WATCH_ADDRESS=f'http://127.0.0.1:{port}/calendar/notifications' if watch else '')
+
+    if server == 'gunicorn':
+        # same settings as in the Procfile
+        args = [
+            sys.executable, '-m', 'gunicorn',
+            '-w', str(workers), '--threads', str(threads), '--timeout', '60',
+            '-b', f'127.0.0.1:{port}',
+            'scout_sync.bench.stubs:stub_app_startup()']
+    else:
+        args = [
+            sys.executable, '-c',
+            'from scout_sync.bench.stubs import stub_app_startup; '
+            f'stub_app_startup().run(host="127.0.0.1", port={port}, threaded=True)']
+
+    process = subprocess.Popen(args, cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with status {process.returncode}')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError('Server did not start')
+
+
+class Recorder:
+    """Collects (endpoint, latency, status) of the requests from all client threads"""
+
+    def __init__(self):
+        self.results = {}
+        self.__lock = threading.Lock()
+
+    def record(self, endpoint, latency, status):
+        with self.__lock:
+            self.results.setdefault(endpoint, []).append((latency, status))
+
+
+def request(recorder, base_url, endpoint, method='GET', body=None, headers=None):
+    """Send a request and record its latency and status
+    Returns the response body and headers or (None, None) on errors"""
+
+    data = json.dumps(body).encode('utf8') if body is not None else None
+    req = urllib.request.Request(
+        base_url + endpoint, data=data, method=method,
+        headers={'Content-Type': 'application/json', **(headers or {})})
+
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=60) as response:
+            content = response.read()
+            response_headers = response.headers
+            status = response.status
+    except urllib.error.HTTPError as e:
+        content, response_headers = None, None
+        status = e.code
+    except (OSError, ValueError):
+        # connection errors and invalid requests are recorded with status 0
+        content, response_headers = None, None
+        status = 0
+
+    recorder.record(endpoint.split('?')[0], time.perf_counter() - start, status)
+    return content, response_headers
+
+
+def run_clients(count, rate, until, client):
+    """Start 'count' threads that each call client() 'rate' times per second until 'until'"""
+
+    def loop():
+        interval = 1 / rate
+        next_call = time.perf_counter() + random.random() * interval
+        while time.time() < until:
+            delay = next_call - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            client()
+            next_call += interval
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(count)]
+    for t in threads:
+        t.start()
+
+    return threads
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def report(recorder, duration):
+    print(
+        f"{'endpoint':<20} {'requests':>8} {'req/s':>8} {'p50 [ms]':>9} {'p95 [ms]':>9} {'p99 [ms]':>9} "
+        f"{'errors':>7} {'conflicts':>9}")
+    for endpoint, results in sorted(recorder.results.items()):
+        latencies = sorted(latency * 1000 for latency, _ in results)
+        # 409 is the expected answer to an edit based on an outdated cache version
+        conflicts = sum(1 for _, status in results if status == 409)
+        errors = sum(1 for _, status in results if not 200 <= status < 400) - conflicts
+        print(
+            f"{endpoint:<20} {len(results):>8} {len(results) / duration:>8.1f} "
+            f"{percentile(latencies, 50):>9.1f} {percentile(latencies, 95):>9.1f} "
+            f"{percentile(latencies, 99):>9.1f} {errors:>7} {conflicts:>9}")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--events', type=int, default=300, help='number of events in the synthetic cache')
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--read-rate', type=float, default=5, help='requests per second per reader')
+    parser.add_argument('--ical', action='store_true', help='readers also request /list/events.ics')
+    parser.add_argument('--editors', type=int, default=1)
+    parser.add_argument('--edit-rate', type=float, default=0.2, help='submits per second per editor')
+    parser.add_argument('--sync-interval', type=float, default=0, help='seconds between syncs from the schedule')
+    parser.add_argument('--watch', action='store_true', help='enable the calendar notifications')
+    parser.add_argument('--stub-latency', type=float, default=0.005, help='seconds per calendar request')
+    parser.add_argument('--server', choices=['gunicorn', 'werkzeug'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8765)
+
+    ARGS = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        with open(os.path.join(work_dir, 'events.json.cache'), 'w', encoding='utf8') as cache_file:
+            json.dump(synthetic_events(ARGS.events), cache_file, ensure_ascii=False)
+
+        server = start_server(
+            work_dir, ARGS.port, ARGS.server, ARGS.workers, ARGS.threads, ARGS.stub_latency, ARGS.sync_interval, ARGS.watch)
+        base_url = f'http://127.0.0.1:{ARGS.port}'
+        recorder = Recorder()
+
+        def reader():
+            request(recorder, base_url, '/list/events')
+            if ARGS.ical:
+                query = urllib.parse.urlencode({'scouter': random.choice(list(SCOUTERS))})
+                request(recorder, base_url, f'/list/events.ics?{query}')
+
+        def editor():
+            content, headers = request(recorder, base_url, '/list/events')
+            if content is None:
+                return
+
+            events = json.loads(content)
+            for ev in random.sample(events, min(3, len(events))):
+                ev['scouters'] = random.sample(list(SCOUTERS), random.randint(0, 3))
+            request(
+                recorder, base_url, '/list/edit', 'POST', {'password': PASSWORD, 'events': events},
+                headers={'If-Match': headers.get('ETag', '')})
+
+        try:
+            until = time.time() + ARGS.duration
+            threads = run_clients(ARGS.readers, ARGS.read_rate, until, reader)
+            if ARGS.editors:
+                threads += run_clients(ARGS.editors, ARGS.edit_rate, until, editor)
+            for t in threads:
+                t.join()
+
+        finally:
+            server.terminate()
+            server.wait()
+
+        report(recorder, ARGS.duration)
@@ -0,0 +1,304 @@
+"""Offline stand-ins for the Google Calendar API and the DBB schedule
+
+install() replaces the calendar and schedule handlers of the sync with stubs that keep
+the calendar in memory and generate the league schedules, so the app can be run and
+synced without network access. stub_app_startup() can be used as gunicorn app factory:
+
+    gunicorn 'scout_sync.bench.stubs:stub_app_startup()'
+
+The stubs are configured with environment variables:
+SCOUT_SYNC_STUB_LATENCY -> seconds added to each calendar request (default 0.005)
+SCOUT_SYNC_STUB_MATCHES -> number of generated home matches per league (default 20)
+SCOUT_SYNC_STUB_SYNC_INTERVAL -> seconds between scheduled syncs from the schedule (default 0 = off)
+SCOUT_SYNC_STUB_WATCH_ADDRESS -> URL of the calendar webhook of the app, enables the calendar
+                                 notifications, which the in-memory calendar posts to the app
+
+manual_change() changes an event like a user in the Google Calendar web interface, which also
+posts a notification to the registered channels."""
+
+import os
+import copy
+import time
+import random
+import itertools
+import threading
+import importlib
+import urllib.request
+from datetime import datetime, timedelta
+from ..sync import dates, calendar_watch
+
+# the sync module, its name is shadowed by the sync function in the package
+sync_module = importlib.import_module('..sync.sync', __package__)
+
+TIMEZONE = 'Europe/Berlin'
+LEAGUES = ['BBL', 'ProB', 'Regio', 'NBBL', 'JBBL']
+ARENAS = ['Arena', 'Main Court', 'Listhalle', 'Kuhberghalle']
+OPPONENTS = ['Bamberg', 'Bonn', 'Crailsheim', 'Würzburg', 'Ludwigsburg', 'München', 'Berlin']
+SCOUTERS = {f'Scouter {i}': f'scouter{i}@example.com' for i in range(8)}
+
+
+class _Request:
+    """Stand-in for a googleapiclient HttpRequest"""
+
+    def __init__(self, func, latency):
+        self.__func = func
+        self.__latency = latency
+
+    def execute(self):
+        time.sleep(self.__latency)
+        return self.__func()
+
+
+def post_notification(channel, state, message_number):
+    """Post a push notification of the channel to its address, like the Google Calendar API"""
+
+    req = urllib.request.Request(
+        channel['address'], data=b'', method='POST',
+        headers={
+            'X-Goog-Channel-ID': channel['id'],
+            'X-Goog-Channel-Token': channel.get('token', ''),
+            'X-Goog-Channel-Expiration': time.strftime(
+                '%a, %d %b %Y %H:%M:%S GMT', time.gmtime(channel['expiration'] / 1000)),
+            'X-Goog-Resource-ID': channel['resourceId'],
+            'X-Goog-Resource-State': state,
+            'X-Goog-Message-Number': str(message_number)})
+    try:
+        urllib.request.urlopen(req, timeout=10).close()
+    except OSError:
+        # like the Google Calendar API, failed notifications are not retried here
+        pass
+
+
+class FakeCalendarService:
+    """In-memory stand-in for the events and channels resources of the Google Calendar API service
+    The sync tokens are positions in the list of changed event IDs."""
+
+    def __init__(self, latency=0.0):
+        self.__events = {}
+        self.__changes = []
+        self.__channels = {}
+        self.__messages = itertools.count(1)
+        self.__ids = itertools.count()
+        self.__lock = threading.Lock()
+        self.latency = latency
+        self.requests = 0
+
+    def events(self):
+        return self
+
+    def channels(self):
+        return self
+
+    def __changed(self, event_id):
+        """record the change and notify the channels, has to be called with the lock held"""
+        self.__changes.append(event_id)
+        for channel in self.__channels.values():
+            threading.Thread(
+                target=post_notification, args=(channel, 'exists', next(self.__messages)), daemon=True).start()
+
+    def __request(self, func):
+        with self.__lock:
+            self.requests += 1
+        return _Request(func, self.latency)
+
+    @staticmethod
+    def __with_response_status(event):
+        for attendee in event.get('attendees') or []:
+            attendee.setdefault('responseStatus', 'needsAction')
+        return event
+
+    def list(self, calendarId, timeMin=None, syncToken=None, **kwargs):
+        def run():
+            with self.__lock:
+                if syncToken is not None:
+                    changed_ids = dict.fromkeys(self.__changes[int(syncToken):])
+                    items = [
+                        copy.deepcopy(self.__events[i]) if i in self.__events else {'id': i, 'status': 'cancelled'}
+                        for i in changed_ids]
+                else:
+                    items = [copy.deepcopy(e) for e in self.__events.values()]
+                next_sync_token = str(len(self.__changes))
+
+            if syncToken is not None:
+                return {'items': items, 'nextSyncToken': next_sync_token}
+
+            if timeMin:
+                time_min = dates.parse_iso(timeMin)
+                items = [e for e in items if dates.parse_iso(e['end']['dateTime']) > time_min]
+            return {
+                'items': sorted(items, key=lambda e: dates.parse_iso(e['start']['dateTime'])),
+                'nextSyncToken': next_sync_token}
+
+        return self.__request(run)
+
+    def get(self, calendarId, eventId):
+        def run():
+            with self.__lock:
+                return copy.deepcopy(self.__events[eventId])
+
+        return self.__request(run)
+
+    def insert(self, calendarId, body, **kwargs):
+        def run():
+            event = self.__with_response_status(copy.deepcopy(body))
+            with self.__lock:
+                event['id'] = f'stub{next(self.__ids)}'
+                event['etag'] = f'"{time.time_ns()}"'
+                self.__events[event['id']] = event
+                self.__changed(event['id'])
+            return copy.deepcopy(event)
+
+        return self.__request(run)
+
+    def patch(self, calendarId, eventId, body, **kwargs):
+        def run():
+            with self.__lock:
+                event = self.__events[eventId]
+                event.update(self.__with_response_status(copy.deepcopy(body)))
+                event['etag'] = f'"{time.time_ns()}"'
+                self.__changed(eventId)
+                return copy.deepcopy(event)
+
+        return self.__request(run)
+
+    def delete(self, calendarId, eventId, **kwargs):
+        def run():
+            with self.__lock:
+                self.__events.pop(eventId)
+                self.__changed(eventId)
+
+        return self.__request(run)
+
+    def watch(self, calendarId, body):
+        def run():
+            channel = dict(
+                body,
+                resourceId=f'stub-{calendarId}',
+                expiration=int((time.time() + int(body.get('params', {}).get('ttl', 604800))) * 1000))
+            with self.__lock:
+                self.__channels[channel['id']] = channel
+            threading.Thread(
+                target=post_notification, args=(channel, 'sync', next(self.__messages)), daemon=True).start()
+            return {
+                'kind': 'api#channel',
+                'id': channel['id'],
+                'resourceId': channel['resourceId'],
+                'expiration': str(channel['expiration'])}
+
+        return self.__request(run)
+
+    def stop(self, body):
+        def run():
+            with self.__lock:
+                self.__channels.pop(body['id'], None)
+
+        return self.__request(run)
+
+    def manual_change(self, eventId, body):
+        """Change the fields in 'body' of the event, like a user in the Google Calendar web interface"""
+        return self.patch(None, eventId, body).execute()
+
+    def find(self, matchNo):
+        """Returns the ID of the calendar event of the event 'matchNo' or None"""
+        with self.__lock:
+            for event in self.__events.values():
+                if event.get('extendedProperties', {}).get('private', {}).get('matchNo') == str(matchNo):
+                    return event['id']
+
+
+calendar_service = FakeCalendarService()
+
+
+class StubCalendarHandler(sync_module.CalendarHandler):
+    """CalendarHandler that uses the in-memory calendar"""
+
+    def _connect_to_service(self):
+        self._service = calendar_service
+
+
+class StubScheduleHandler(sync_module.ScheduleHandler):
+    """ScheduleHandler that generates the league schedules instead of downloading them"""
+
+    matches_per_league = 20
+
+    def connect(self):
+        now = datetime.now(dates.zone(TIMEZONE))
+        rng = random.Random(42)
+        schedule = []
+        for league_no, league_name in enumerate(LEAGUES):
+            for match_no in range(StubScheduleHandler.matches_per_league):
+                kickoff = now + timedelta(days=rng.randint(-30, 150), hours=rng.randint(-4, 4))
+                arena = rng.choice(ARENAS)
+                schedule.append(({
+                    'matchId': league_no * 10000 + match_no,
+                    'matchNo': league_no * 1000 + match_no,
+                    'kickoffDate': kickoff.strftime('%Y-%m-%d'),
+                    'kickoffTime': kickoff.strftime('%H:00'),
+                    'abgesagt': False,
+                    'verzicht': False,
+                    'ligaData': {'ligaId': league_no, 'verbandId': 1},
+                    'guestTeam': {'teamname': rng.choice(OPPONENTS)},
+                    'matchInfo': {'spielfeld': {'id': 1000 + ARENAS.index(arena), 'bezeichnung': arena}}}, league_name))
+
+        self._ScheduleHandler__schedule = schedule
+        self._ScheduleHandler__failed_league_downloads = []
+        self._ScheduleHandler__failed_match_downloads = []
+        return True
+
+
+def synthetic_events(count, seed=42):
+    """Returns a list of 'count' events in the web cache JSON format around the current date"""
+
+    rng = random.Random(seed)
+    now = datetime.now(dates.zone(TIMEZONE)).replace(minute=0, second=0, microsecond=0)
+    events = []
+    for i in range(count):
+        events.append({
+            'id': f'synthetic_{i}',
+            'datetime': dates.format_json(now + timedelta(days=rng.randint(-30, 150), hours=rng.randint(-4, 4))),
+            'location': rng.choice(ARENAS),
+            'league': rng.choice(LEAGUES),
+            'opponent': rng.choice(OPPONENTS),
+            'scouters': rng.sample(list(SCOUTERS), rng.randint(0, 3)),
+            'schedule_info': None})
+
+    return events
+
+
+def install():
+    """Replace the calendar and schedule handlers of the sync with the stubs"""
+
+    calendar_service.latency = float(os.getenv('SCOUT_SYNC_STUB_LATENCY', '0.005'))
+    StubScheduleHandler.matches_per_league = int(os.getenv('SCOUT_SYNC_STUB_MATCHES', '20'))
+    sync_module.CalendarHandler = StubCalendarHandler
+    sync_module.ScheduleHandler = StubScheduleHandler
+    calendar_watch.CalendarHandler = StubCalendarHandler
+
+
+def stub_app_startup():
+    """app factory that runs the app with the stubbed backends"""
+
+    from ..app import app, app_startup
+    from ..app.app import get_scheduler
+    from ..config import config, load_config
+
+    install()
+    load_config()
+    config['COMMON']['timezone'] = TIMEZONE
+    config['COMMON']['simulate'] = 'False'
+    config['SHEET']['id'] = ''
+    config['SYNC_WORKER']['enabled'] = 'False'
+    config['CALENDAR_WATCH']['address'] = os.getenv('SCOUT_SYNC_STUB_WATCH_ADDRESS', '')
+    config['CALENDAR_WATCH']['enabled'] = str(bool(config['CALENDAR_WATCH']['address']))
+    for name, email in SCOUTERS.items():
+        config['EMAILS'][name] = email
+    config.remove_section('SYNC_JOB')
+
+    app_startup()
+
+    sync_interval = float(os.getenv('SCOUT_SYNC_STUB_SYNC_INTERVAL', '0'))
+    if sync_interval:
+        get_scheduler().add_job(
+            sync_module.sync, 'interval', kwargs={'source': 'schedule'}, seconds=sync_interval)
+
+    return app
@@ -1,27 +1,138 @@
+"""Configuration of the app and the sync
+
+The config file is not read on import. The entry points have to call load_config() once
+before the config is used. reload_config() picks up changes of the config file while the
+app is running."""
+
 import os
 import json
+import threading
 from configparser import ConfigParser
 
 CONFIG_FILE = 'scout_sync.cfg'
 
-config = ConfigParser(
-    converters={'list': lambda line: [int(v) if v.isdigit() else v for v in [w.strip() for w in line.split(',')]]},
-    interpolation=None)
-config.optionxform = str
-config.read(os.path.join(__path__[0], CONFIG_FILE), encoding='utf8')
+class _Config(ConfigParser):
+    """ConfigParser whose values are replaced by reload_config() at once
+    the reads wait while the values are replaced, so they never see a partly reloaded config"""
+
+    def __init__(self, *args, **kwargs):
+        self.__lock = threading.RLock()
+        super().__init__(*args, **kwargs)
+
+    def replace(self, parser):
+        """replace all sections and values with the ones of 'parser'"""
+        with self.__lock:
+            for section in self.sections():
+                self.remove_section(section)
+
+            self.read_dict(parser)
+
+    def get(self, *args, **kwargs):
+        with self.__lock:
+            return super().get(*args, **kwargs)
+
+    def items(self, *args, **kwargs):
+        with self.__lock:
+            return super().items(*args, **kwargs)
+
+    def sections(self):
+        with self.__lock:
+            return super().sections()
+
+    def options(self, section):
+        with self.__lock:
+            return super().options(section)
+
+    def has_section(self, section):
+        with self.__lock:
+            return super().has_section(section)
+
+    def has_option(self, section, option):
+        with self.__lock:
+            return super().has_option(section, option)
+
+    def __getitem__(self, key):
+        with self.__lock:
+            return super().__getitem__(key)
+
+def _new_parser(parser_class=ConfigParser):
+    parser = parser_class(
+        converters={'list': lambda line: [int(v) if v.isdigit() else v for v in [w.strip() for w in line.split(',')]]},
+        interpolation=None)
+    parser.optionxform = str
+    return parser
+
+config = _new_parser(_Config)
+
+__loaded = False
+__mtime = None
+
+def _config_path():
+    return os.path.join(__path__[0], CONFIG_FILE)
+
+def _read_config(parser):
+    """read the config file and the environment variables into the parser
+    returns the modification time of the config file"""
+
+    try:
+        mtime = os.stat(_config_path()).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+
+    parser.read(_config_path(), encoding='utf8')
+
+    # read email adresses and calendar auth infos from environment variables for Replit compatibility
+    for name, email in json.loads(os.getenv('EMAILS', default='{}')).items():
+        if not parser.has_option('EMAILS', name):
+            parser['EMAILS'][name] = email
+
+    if not parser.get('COMMON', 'submit_pw', fallback=None):
+        parser['COMMON']['submit_pw'] = os.getenv('SUBMIT_PW', default='')
+
+    if not parser.get('COMMON', 'admin_pw', fallback=None):
+        parser['COMMON']['admin_pw'] = os.getenv('ADMIN_PW', default='')
+
+    if not parser.get('GOOGLE_API', 'oauth_info', fallback=None):
+        parser['GOOGLE_API']['oauth_info'] = os.getenv('OAUTH_INFO', default='')
+
+    if not parser.get('GOOGLE_API', 'service_account_info', fallback=None):
+        parser['GOOGLE_API']['service_account_info'] = os.getenv('SERVICE_ACCOUNT_INFO', default='')
+
+    return mtime
+
+def load_config():
+    """read the config file and the environment variables
+    subsequent calls do nothing"""
+
+    global __loaded, __mtime
+    if __loaded:
+        return config
+
+    __mtime = _read_config(config)
+    __loaded = True
+    return config
+
+def reload_config():
+    """read the config file again if it has been changed since it was read
+    the file is read into a new parser and its values replace the ones of the config at once
+    returns whether the config has been reloaded"""
 
-# read email adresses and calendar auth infos from environment variables for Replit compatibility
-for name, email in json.loads(os.getenv('EMAILS', default='{}')).items():
-    if not config.has_option('EMAILS', name):
-        config['EMAILS'][name] = email
+    global __mtime
+    if not __loaded:
+        load_config()
+        return True
 
-if not config.get('COMMON', 'submit_pw', fallback=None):
-    config['COMMON']['submit_pw'] = os.getenv('SUBMIT_PW', default='')
+    try:
+        mtime = os.stat(_config_path()).st_mtime_ns
+    except FileNotFoundError:
+        return False
 
-if not config.get('GOOGLE_API', 'oauth_info', fallback=None):
-    config['GOOGLE_API']['oauth_info'] = os.getenv('OAUTH_INFO', default='')
+    if mtime == __mtime:
+        return False
 
-if not config.get('GOOGLE_API', 'service_account_info', fallback=None):
-    config['GOOGLE_API']['service_account_info'] = os.getenv('SERVICE_ACCOUNT_INFO', default='')
+    fresh = _new_parser()
+    __mtime = _read_config(fresh)
+    config.replace(fresh)
+    return True
 
-__all__ = ['config']
+__all__ = ['config', 'load_config', 'reload_config']
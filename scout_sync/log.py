@@ -0,0 +1,123 @@
+"""Logging setup for the app and the sync command line interface
+
+Records are written as JSON lines. The handlers only put the records into a queue,
+formatting and file I/O happen in the thread of a QueueListener.
+Additional fields can be attached to a record with `extra={'data': {...}}`."""
+
+import sys
+import json
+import time
+import queue
+import atexit
+import collections
+import logging
+import threading
+import logging.handlers
+
+__configured = False
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single JSON line"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()}
+
+        data = getattr(record, 'data', None)
+        if data:
+            entry['data'] = data
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Drops warnings that were already logged with the same message within the interval
+    Only the last 'max_keys' distinct warnings are remembered, the oldest are forgotten first."""
+
+    def __init__(self, interval, max_keys=1000):
+        """interval -> float seconds in which a repeated warning is suppressed
+        max_keys -> int number of distinct warnings that are remembered"""
+        super().__init__()
+        self.__interval = interval
+        self.__max_keys = max_keys
+        self.__last_seen = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or record.levelno >= logging.ERROR:
+            return True
+
+        # the unformatted message, records with arguments are rate limited per call site
+        key = (record.pathname, record.lineno, str(record.msg))
+        now = time.monotonic()
+        with self.__lock:
+            last_seen = self.__last_seen.get(key)
+            if last_seen is not None and now - last_seen < self.__interval:
+                return False
+
+            self.__last_seen[key] = now
+            self.__last_seen.move_to_end(key)
+            while len(self.__last_seen) > self.__max_keys:
+                self.__last_seen.popitem(last=False)
+
+        return True
+
+
+def setup_logging(log_file=None, level='INFO', max_bytes=0, backup_count=0, warning_interval=0):
+    """configure the root logger
+    log_file -> string path of the log file, logs to stderr if empty
+    level -> string or int log level
+    max_bytes -> int size at which the log file is rotated, 0 disables rotation
+    backup_count -> int number of rotated log files to keep
+    warning_interval -> float seconds in which a repeated warning is suppressed
+    subsequent calls do nothing"""
+
+    global __configured
+    if __configured:
+        return
+
+    if log_file:
+        handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf8')
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    if warning_interval:
+        queue_handler.addFilter(RateLimitFilter(warning_interval))
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+
+    logging.getLogger('googleapiclient').setLevel(logging.ERROR)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    logging.getLogger('apscheduler').setLevel(logging.ERROR)
+    sys.excepthook = lambda exc_type, exc_value, exc_traceback: logging.exception(
+        exc_type.__name__, exc_info=(exc_type, exc_value, exc_traceback))
+
+    __configured = True
+
+
+def setup_logging_from_config(config, log_file=None):
+    """configure the root logger from the COMMON config section
+    log_file -> replaces COMMON.log_file for processes that must not rotate the log file of the app"""
+
+    setup_logging(
+        config.get('COMMON', 'log_file') if log_file is None else log_file,
+        level=config.get('COMMON', 'log_level', fallback='INFO'),
+        max_bytes=config.getint('COMMON', 'log_max_bytes', fallback=10 * 1024 * 1024),
+        backup_count=config.getint('COMMON', 'log_backup_count', fallback=0),
+        warning_interval=config.getfloat('COMMON', 'log_warning_interval', fallback=0))
+
+__all__ = ['setup_logging', 'setup_logging_from_config', 'JsonFormatter', 'RateLimitFilter']
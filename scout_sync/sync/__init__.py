@@ -1,4 +1,5 @@
-from .sync import sync, Event, WebCacheHandler
+from .sync import sync, Event, WebCacheHandler, ArchiveHandler, CacheConflictError
 from .google_api import refresh_oauth_token
+from .profiling import sync_job
 
-__all__ = ['sync', 'Event', 'WebCacheHandler', 'refresh_oauth_token']
+__all__ = ['sync', 'Event', 'WebCacheHandler', 'ArchiveHandler', 'CacheConflictError', 'refresh_oauth_token', 'sync_job']
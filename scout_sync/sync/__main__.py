@@ -1,20 +1,65 @@
 from argparse import ArgumentParser
-from .sync import sync
-from .google_api import refresh_oauth_token
+from ..config import config, load_config
+from ..log import setup_logging_from_config
 
 parser = ArgumentParser()
 parser.add_argument('--from', dest='source',
-                    choices=['cache', 'schedule'])
+                    choices=['cache', 'schedule', 'calendar'])
+parser.add_argument('--plan-out', metavar='PLAN_FILE',
+                    help='only write the changes of the sync to the plan file (JSON)')
+parser.add_argument('--apply', metavar='PLAN_FILE',
+                    help='apply the changes of a plan file written with --plan-out')
 parser.add_argument('--refresh-credentials', action='store_true')
+parser.add_argument('--profile', action='store_true',
+                    help='profile the sync, plan or apply with cProfile, see the PROFILING config section')
+parser.add_argument('--profile-memory', action='store_true',
+                    help='also write a tracemalloc snapshot of the sync')
 
 ARGS = parser.parse_args()
 
+if ARGS.plan_out and ARGS.source not in ('cache', 'schedule'):
+    parser.error('--plan-out requires --from cache or --from schedule')
+if ARGS.apply and ARGS.source:
+    parser.error('--apply can not be combined with --from')
+
+if ARGS.source or ARGS.apply or ARGS.refresh_credentials:
+    load_config()
+    setup_logging_from_config(config)
+
 if ARGS.refresh_credentials:
+    from .google_api import refresh_oauth_token
+
     credentials = refresh_oauth_token()
     print(credentials.to_json())
     
-if ARGS.source:
-    sync(ARGS.source)
+if ARGS.plan_out:
+    from .sync import plan_sync
+
+    label, func, args = 'plan', plan_sync, (ARGS.source, ARGS.plan_out)
+
+elif ARGS.apply:
+    from .sync import apply_sync_plan
+
+    label, func, args = 'apply', apply_sync_plan, (ARGS.apply,)
+
+elif ARGS.source:
+    from .sync import sync
+
+    label, func, args = ARGS.source, sync, (ARGS.source,)
+
+if ARGS.source or ARGS.apply:
+    if ARGS.profile or ARGS.profile_memory:
+        from .profiling import profile_run
+
+        profile_run(
+            label,
+            func,
+            *args,
+            profile_dir=config.get('PROFILING', 'profile_dir'),
+            keep=config.getint('PROFILING', 'keep'),
+            memory=ARGS.profile_memory)
+    else:
+        func(*args)
 
-if not (ARGS.source or ARGS.refresh_credentials):
+if not (ARGS.source or ARGS.apply or ARGS.refresh_credentials):
     parser.print_usage()
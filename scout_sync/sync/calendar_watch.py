@@ -0,0 +1,251 @@
+"""Push notifications for changes of the Google Calendar events
+
+A notification channel (events().watch) is registered for the calendar. It posts to the
+webhook of the app on every change, and each notification triggers an incremental read of
+the changed events (sync('calendar')), which updates the web cache. The channel is renewed
+before it expires.
+
+The state file contains the channel, the sync token of the last incremental read, the
+mapping of calendar event IDs to event IDs (deleted events only come with the calendar ID)
+and the events as they were last read from the calendar:
+{"channel": {"id", "resource_id", "token", "expiration"}, "sync_token", "ids": {calendar id: event id},
+ "events": {event id: event JSON}}
+
+A cache entry that differs from the last read calendar event has an edit of the web page that
+is not yet synced to the calendar. Calendar changes of these events are not applied to the
+cache, the pending sync from the cache writes the edit to the calendar."""
+
+import os
+import json
+import time
+import uuid
+import hmac
+import secrets
+import logging
+from . import dates
+from .google_api import SyncTokenExpiredError
+from .sync import Event, CalendarHandler, WebCacheHandler, CacheConflictError, FileLock, local_now, current_season_start
+from ..config import config
+
+# attempts to store the changes if the cache is changed at the same time
+__STORE_ATTEMPTS = 3
+
+
+def watch_enabled():
+    return config.getboolean('CALENDAR_WATCH', 'enabled', fallback=False)
+
+
+def sync_job_interval():
+    """interval of the sync job from the schedule in minutes
+    with notifications it is only a reconciliation, so it runs less often"""
+
+    if watch_enabled():
+        return config.getint('CALENDAR_WATCH', 'reconcile_interval')
+
+    return config.getint('SYNC_JOB', 'interval')
+
+
+class WatchStateHandler():
+    """Manages the state file of the calendar notifications"""
+
+    def __init__(self, state_file_name):
+        self.__file_name = state_file_name
+        try:
+            with open(state_file_name, encoding='utf8') as state_file:
+                state = json.load(state_file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            state = {}
+
+        self.channel = state.get('channel')
+        self.sync_token = state.get('sync_token')
+        self.ids = state.get('ids', {})
+        self.events = state.get('events', {})
+
+    def lock(self):
+        """lock that serializes the changes of the state between threads and processes"""
+        return FileLock(f"{self.__file_name}.lock")
+
+    def store(self):
+        tmp_file_name = f"{self.__file_name}.tmp"
+        with open(tmp_file_name, 'w', encoding='utf8') as state_file:
+            json.dump(
+                {'channel': self.channel, 'sync_token': self.sync_token, 'ids': self.ids, 'events': self.events},
+                state_file, ensure_ascii=False)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+
+        os.replace(tmp_file_name, self.__file_name)
+
+
+def _state_file_name():
+    return config.get('CALENDAR_WATCH', 'state_file')
+
+
+def valid_notification(channel_id, token):
+    """Returns whether the notification belongs to the current channel"""
+
+    channel = WatchStateHandler(_state_file_name()).channel
+    if not channel:
+        return False
+
+    return (
+        hmac.compare_digest(channel_id.encode(), channel['id'].encode()) and
+        hmac.compare_digest(token.encode(), channel['token'].encode()))
+
+
+def renew_watch():
+    """Register a new notification channel if there is none or the current one expires soon
+    the old channel is stopped after the new one has been registered"""
+
+    address = config.get('CALENDAR_WATCH', 'address', fallback='')
+    if not watch_enabled() or not address:
+        return
+
+    state_hdl = WatchStateHandler(_state_file_name())
+    with state_hdl.lock():
+        state_hdl = WatchStateHandler(_state_file_name())
+        old_channel = state_hdl.channel
+        renew_before = config.getint('CALENDAR_WATCH', 'renew_before') * 1000
+        if old_channel and old_channel['expiration'] - renew_before > time.time() * 1000:
+            return
+
+        calendar_hdl = CalendarHandler(config.get('CALENDAR', 'id'))
+        if not calendar_hdl.connect():
+            raise RuntimeError('Connection to the calendar failed.')
+
+        # the 'sync' notification of the new channel may arrive before the channel is stored and is rejected,
+        # it does not report any changes
+        channel = {'id': str(uuid.uuid4()), 'token': secrets.token_urlsafe(32)}
+        response = calendar_hdl._watch_events(
+            channel['id'], address, channel['token'], config.getint('CALENDAR_WATCH', 'ttl'))
+        channel['resource_id'] = response['resourceId']
+        channel['expiration'] = int(response['expiration'])
+
+        state_hdl.channel = channel
+        state_hdl.store()
+
+    logging.info(
+        f"Registered calendar notification channel {channel['id']}",
+        extra={'data': {'phase': 'watch', 'expiration': channel['expiration']}})
+
+    if old_channel:
+        try:
+            calendar_hdl._stop_channel(old_channel['id'], old_channel['resource_id'])
+        except Exception as e:
+            logging.warning(f"Stopping calendar notification channel {old_channel['id']} failed: {e}")
+
+    # start tracking the changes from the current state of the calendar
+    if state_hdl.sync_token is None:
+        sync_changes()
+
+
+def sync_changes():
+    """Read the calendar events that changed since the last read and update them in the web cache
+    without a valid sync token all events are read, so the cache is updated from the whole calendar"""
+
+    start_time = time.time()
+    now = local_now()
+    season_start = current_season_start(now)
+
+    calendar_hdl = CalendarHandler(config.get('CALENDAR', 'id'), now)
+    if not calendar_hdl.connect():
+        raise RuntimeError('Connection to the calendar failed.')
+
+    state_hdl = WatchStateHandler(_state_file_name())
+    with state_hdl.lock():
+        state_hdl = WatchStateHandler(_state_file_name())
+        try:
+            changes, sync_token = calendar_hdl._get_changed_events(state_hdl.sync_token)
+        except SyncTokenExpiredError as e:
+            logging.warning(f"{e}, reading all events")
+            state_hdl.ids = {}
+            changes, sync_token = calendar_hdl._get_changed_events()
+
+        for attempt in range(__STORE_ATTEMPTS):
+            cache_hdl = WebCacheHandler(config.get('COMMON', 'web_cache_file'))
+            events = {e.id: e for e in cache_hdl.list_events() or []}
+            ids = dict(state_hdl.ids)
+            calendar_events = dict(state_hdl.events)
+            changed = _apply_changes(changes, events, ids, calendar_events, season_start)
+            if not changed:
+                break
+
+            try:
+                cache_hdl.store_events(
+                    sorted(events.values(), key=lambda e: e.datetime), expected_version=cache_hdl.version)
+                break
+            except CacheConflictError as e:
+                logging.info(f"Events cache was changed during the calendar read, retrying: {e}")
+        else:
+            raise CacheConflictError('Events cache was changed during every attempt to store the calendar changes')
+
+        # the sync token is only advanced when the changes are in the cache
+        state_hdl.ids = ids
+        state_hdl.events = calendar_events
+        state_hdl.sync_token = sync_token
+        state_hdl.store()
+
+    end_time = time.time()
+    logging.info(
+        f"Calendar changes synced ({(end_time-start_time):.1f}s)",
+        extra={'data': {
+            'phase': 'calendar_changes',
+            'read': len(changes),
+            'changed': changed,
+            'duration': round(end_time - start_time, 3)}})
+
+
+def _apply_changes(changes, events, ids, calendar_events, season_start):
+    """Apply the changed calendar events to the events (event id -> Event), the calendar ID mapping
+    and the last read calendar events (event id -> event JSON)
+    events with unsynced edits in the cache are not changed
+    Returns the number of changed events"""
+
+    def unsynced(event_id):
+        cache_ev = events.get(event_id)
+        calendar_ev = calendar_events.get(event_id)
+        return cache_ev is not None and calendar_ev is not None and cache_ev != Event.from_json(calendar_ev)
+
+    changed = 0
+    skipped = []
+    for item in changes:
+        if item.get('status') == 'cancelled':
+            event_id = ids.pop(item['id'], None)
+            if event_id is None:
+                continue
+
+            if unsynced(event_id):
+                skipped.append(event_id)
+            elif events.pop(event_id, None) is not None:
+                changed += 1
+
+            calendar_events.pop(event_id, None)
+            continue
+
+        start = item.get('start', {})
+        if dates.parse_iso(start.get('dateTime') or start.get('date')) < season_start:
+            continue
+
+        event = Event.from_calendar_event(item)
+        if event is None:
+            continue
+
+        ids[item['id']] = event.id
+        old_event = events.get(event.id)
+        if old_event is not None and old_event != event and unsynced(event.id):
+            skipped.append(event.id)
+        elif old_event is None or old_event != event:
+            if old_event is not None:
+                # the calendar only returns the schedule info as strings
+                event.schedule_info = old_event.schedule_info
+            events[event.id] = event
+            changed += 1
+
+        calendar_events[event.id] = event.as_json()
+
+    if skipped:
+        logging.info(
+            f"Skipped calendar changes of {len(skipped)} events with unsynced edits in the cache",
+            extra={'data': {'skipped': skipped}})
+
+    return changed
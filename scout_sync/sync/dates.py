@@ -0,0 +1,80 @@
+"""Date and time helpers for the sync, based on the standard library
+
+All returned datetimes are timezone aware. Timezone objects are cached by name."""
+
+from functools import cache
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+# returned for events without a readable date
+INVALID_DATE_TIMESTAMP = 2147483648
+
+__SERIAL_EPOCH = datetime(1899, 12, 30)
+__MAX_SECONDS_TIMESTAMP = 1e11
+
+
+@cache
+def zone(name):
+    """Returns the timezone object for a timezone name"""
+    return ZoneInfo(name)
+
+
+def now(tz_name):
+    return datetime.now(zone(tz_name))
+
+
+def from_timestamp(timestamp, tz_name):
+    """Converts a timestamp in seconds or milliseconds"""
+    if abs(timestamp) > __MAX_SECONDS_TIMESTAMP:
+        timestamp /= 1000
+
+    return datetime.fromtimestamp(timestamp, zone(tz_name))
+
+
+def invalid_date(tz_name):
+    return from_timestamp(INVALID_DATE_TIMESTAMP, tz_name)
+
+
+def parse_iso(text):
+    """Parses an ISO 8601 date or datetime as returned by the Google Calendar API
+    dates and datetimes without offset are interpreted as UTC"""
+    dt = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+
+    return dt
+
+
+def parse_local(text, tz_name):
+    """Parses an ISO 8601 datetime as wall clock time in the timezone, an offset in the text is ignored"""
+    return datetime.fromisoformat(text.replace('Z', '+00:00')).replace(tzinfo=zone(tz_name))
+
+
+def format_json(dt):
+    """Formats a datetime for the web cache, e.g. '2025-01-31 19:30:00+01:00'"""
+    return dt.isoformat(sep=' ', timespec='seconds')
+
+
+def to_serial(dt):
+    """Converts a datetime to a spreadsheet serial number (days since 1899-12-30, wall clock time)"""
+    return (dt.replace(tzinfo=None) - __SERIAL_EPOCH).total_seconds() / (60 * 60 * 24)
+
+
+def from_serial(serial, tz_name):
+    """Converts a spreadsheet serial number to a datetime in the timezone"""
+    return (__SERIAL_EPOCH + timedelta(days=serial)).replace(tzinfo=zone(tz_name))
+
+
+def season_start(dt, month, day):
+    """Returns the start of the season that contains the datetime, every season starts on month/day"""
+    start = dt.replace(month=month, day=day, hour=0, minute=0, second=0, microsecond=0)
+    if start > dt:
+        start = start.replace(year=start.year - 1)
+
+    return start
+
+
+def season_name(dt, month, day):
+    """Returns the name of the season that contains the datetime, e.g. '2025-26'"""
+    start = season_start(dt, month, day)
+    return f"{start.year}-{(start.year + 1) % 100:02d}"
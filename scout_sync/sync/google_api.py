@@ -1,14 +1,20 @@
 import os
 import json
-import google
-import googleapiclient.discovery
-import google_auth_oauthlib
-import arrow
+import bisect
+from . import dates, transport
 from ..config import config
 
+class SyncTokenExpiredError(RuntimeError):
+    """The sync token of an incremental calendar read is no longer valid, a full read is needed"""
+
+
 class _GoogleAPI:
     """Base class for the Google API functionality"""
 
+    __SCOPES = {
+        'calendar': ['https://www.googleapis.com/auth/calendar'],
+        'sheets': ['https://www.googleapis.com/auth/spreadsheets']}
+
     def __init__(self, resource_id, timezone, simulate):
         """resource_id -> string Id of the calendar, spreadsheet, ...
         timezone -> string timezone for calendar event creation
@@ -23,7 +29,12 @@ class _GoogleAPI:
         api_name -> string
         api_version -> string"""
 
+        import googleapiclient.discovery
+
         def credentials_from_oauth_info(oauth_info):
+            import google.oauth2.credentials
+            import google.auth.transport.requests
+
             credentials = google.oauth2.credentials.Credentials.from_authorized_user_info(
                 json.loads(oauth_info) if oauth_info else None)
             if not credentials.valid and credentials.expired and credentials.refresh_token:
@@ -32,6 +43,8 @@ class _GoogleAPI:
             return credentials
         
         def credentials_from_service_account_info(account_info):
+            import google.oauth2.service_account
+
             credentials = google.oauth2.service_account.Credentials.from_service_account_info(
                 json.loads(account_info) if account_info else None)
 
@@ -42,21 +55,36 @@ class _GoogleAPI:
 
         # prioritise authentication with oauth
         if oauth_info:
-            credentials = credentials_from_oauth_info(oauth_info)
+            key = (api_name, 'oauth', oauth_info)
+            create_credentials = lambda: credentials_from_oauth_info(oauth_info)
         elif service_account_info:
-            credentials = credentials_from_service_account_info(service_account_info)
+            key = (api_name, 'service_account', service_account_info)
+            create_credentials = lambda: credentials_from_service_account_info(service_account_info)
         else:
             raise ValueError(f'No authentication information provided for Google API "{api_name}"')
-        
+
+        def scoped_credentials():
+            import google.auth.credentials
+
+            # build() only adds the scopes when it creates the transport itself
+            return google.auth.credentials.with_scopes_if_required(
+                create_credentials(), _GoogleAPI.__SCOPES[api_name])
+
+        # the authorized transport is shared by all services of the process
         self._service = googleapiclient.discovery.build(
-            api_name, api_version, credentials=credentials, static_discovery=False)
+            api_name, api_version, http=transport.authorized_http(key, scoped_credentials), static_discovery=False)
 
 
 class GoogleCalendarAPI(_GoogleAPI):
     """Convenience class for Google Calendar API functionalities"""
 
-    def __init__(self, calendar_id, timezone, simulate=False):
+    def __init__(self, calendar_id, timezone, simulate=False, now=None):
+        """now -> datetime used as the current time for all writes, the time of each write if None"""
         super().__init__(calendar_id,  timezone, simulate)
+        self.__now = now
+
+    def _now(self):
+        return self.__now or dates.now(self._GoogleAPI__timezone)
 
     def _connect_to_service(self):
         """Creates the service and tests the connection"""
@@ -66,16 +94,64 @@ class GoogleCalendarAPI(_GoogleAPI):
         # test the connection
         self._service.events().list(calendarId=self._resource_id).execute()
     
-    def _get_all_events(self):
-        """Returns al list of all events in the calendar"""
+    def _get_all_events(self, time_min=None):
+        """Returns al list of all events in the calendar
+        if 'time_min' is set, only events that end after it are returned"""
 
         events = self._service.events().list(
             calendarId=self._resource_id,
             singleEvents=True,
-            orderBy='startTime').execute()  
+            orderBy='startTime',
+            timeMin=time_min.isoformat() if time_min else None).execute()  
 
         return events.get('items', [])
     
+    def _get_changed_events(self, sync_token=None):
+        """Returns a tuple of the events that changed since the sync token was issued and the next sync token
+        deleted events only contain the id and the status 'cancelled'
+        without a sync token all events of the calendar are returned
+        Raises a SyncTokenExpiredError if the calendar requires a full read"""
+
+        import googleapiclient.errors
+
+        events = []
+        page_token = None
+        while True:
+            try:
+                response = self._service.events().list(
+                    calendarId=self._resource_id,
+                    singleEvents=True,
+                    maxResults=2500,
+                    syncToken=sync_token,
+                    pageToken=page_token).execute()
+            except googleapiclient.errors.HttpError as e:
+                if e.resp.status == 410:
+                    raise SyncTokenExpiredError(f"Sync token of calendar {self._resource_id} expired") from e
+                raise
+
+            events.extend(response.get('items', []))
+            page_token = response.get('nextPageToken')
+            if page_token is None:
+                return events, response.get('nextSyncToken')
+
+    def _watch_events(self, channel_id, address, token, ttl):
+        """Registers a notification channel for changes of the calendar events
+        Returns the channel resource with the 'resourceId' and the 'expiration' (ms timestamp)"""
+
+        return self._service.events().watch(
+            calendarId=self._resource_id,
+            body={
+                'id': channel_id,
+                'type': 'web_hook',
+                'address': address,
+                'token': token,
+                'params': {'ttl': str(ttl)}}).execute()
+
+    def _stop_channel(self, channel_id, resource_id):
+        """Stops the notifications of the channel"""
+
+        self._service.channels().stop(body={'id': channel_id, 'resourceId': resource_id}).execute()
+
     def _get_single_event(self, id):
         """Returns the specified event"""
 
@@ -89,8 +165,8 @@ class GoogleCalendarAPI(_GoogleAPI):
         """Inserts the event into the calendar
         the event should be passed as a dict"""
 
-        date = arrow.get(event['start']['dateTime'])
-        now = arrow.now(self._GoogleAPI__timezone)
+        date = dates.parse_iso(event['start']['dateTime'])
+        now = self._now()
         act = self._service.events().insert(
             calendarId=self._resource_id,
             body=event,
@@ -99,27 +175,76 @@ class GoogleCalendarAPI(_GoogleAPI):
         if not self._GoogleAPI__simulate:
             act.execute()
 
-    def _update_event(self, id, event, old_event):
-        """Updates the event with the specified ID
-        the events should be passed as a dicts"""
-        old_date = arrow.get(old_event['start']['dateTime'])
-        new_date = arrow.get(event['start']['dateTime'])
-        now = arrow.now(self._GoogleAPI__timezone)
-
-        act = self._service.events().update(
+    def _patch_event(self, id, patch, old_event, notify=True):
+        """Updates only the fields in 'patch' of the event with the specified ID
+        the attendees are only notified if 'notify' is set and the event is not in the past"""
+        send_updates = 'none'
+        if notify:
+            now = self._now()
+            start_dates = [
+                dates.parse_iso(e['start']['dateTime'])
+                for e in (old_event, patch) if e.get('start', {}).get('dateTime')]
+            if any(date > now for date in start_dates):
+                send_updates = 'all'
+
+        act = self._service.events().patch(
             calendarId=self._resource_id,
             eventId=id,
-            body=event,
-            sendUpdates='all' if old_date > now or new_date > now else 'none')
-        
+            body=patch,
+            sendUpdates=send_updates)
+
         if not self._GoogleAPI__simulate:
             act.execute()
+
+    @staticmethod
+    def _event_patch(old_event, new_event):
+        """Compares a calendar event with the new representation of the event
+        Returns a tuple of the patch with the changed fields and
+        whether fields that are visible to the attendees have changed"""
+
+        def same_time(old, new):
+            if old is None or new is None:
+                return old is new
+            if 'dateTime' not in old or old.get('timeZone') != new.get('timeZone'):
+                return False
+            return dates.parse_iso(old['dateTime']) == dates.parse_iso(new['dateTime'])
+
+        patch = {}
+        for field in ('start', 'end'):
+            if field in new_event and not same_time(old_event.get(field), new_event[field]):
+                patch[field] = new_event[field]
+
+        for field in ('location', 'summary', 'description'):
+            if field in new_event and (old_event.get(field) or None) != (new_event[field] or None):
+                patch[field] = new_event[field]
+
+        if 'attendees' in new_event:
+            old_attendees = {a['email']: a for a in old_event.get('attendees', [])}
+            old_emails = {e for e, a in old_attendees.items() if a.get('responseStatus') != 'declined'}
+            new_emails = {a['email'] for a in new_event['attendees']}
+            if old_emails != new_emails:
+                # keep the response status of the remaining attendees
+                patch['attendees'] = [
+                    old_attendees[a['email']] if a['email'] in old_emails else a
+                    for a in new_event['attendees']]
+
+        notify = bool(patch)
+
+        old_private = old_event.get('extendedProperties', {}).get('private', {})
+        new_private = new_event.get('extendedProperties', {}).get('private', {})
+        if any(old_private.get(k) != v for k, v in new_private.items()):
+            patch['extendedProperties'] = {'private': new_private}
+
+        if 'reminders' in new_event and old_event.get('reminders') != new_event['reminders']:
+            patch['reminders'] = new_event['reminders']
+
+        return patch, notify
     
     def _delete_event(self, id, event):
         """Deletes the specified event"""
 
-        date = arrow.get(event['start']['dateTime'])
-        now = arrow.now(self._GoogleAPI__timezone)
+        date = dates.parse_iso(event['start']['dateTime'])
+        now = self._now()
         act = self._service.events().delete(
             calendarId=self._resource_id,
             eventId=id,
@@ -139,18 +264,20 @@ class GoogleSheetsAPI(_GoogleAPI):
 
     @classmethod
     def serial_to_datetime(cls, serial, timezone):
-        """Converts"""
-        return arrow.get('1899-12-30', tzinfo=timezone).shift(days=serial)
+        """Converts a serial number to a datetime in the timezone"""
+        return dates.from_serial(serial, timezone)
 
     @classmethod
     def datetime_to_serial(cls, datetime):
-        return (datetime.naive - arrow.get('1899-12-30').naive).total_seconds() / (60 * 60 * 24)
+        """Converts a datetime to a serial number of its wall clock time"""
+        return dates.to_serial(datetime)
     
     @classmethod
-    def __insert_row_request(cls, row, sheet_id):
+    def __insert_row_request(cls, row, sheet_id, inherit_from_before=True):
+        """the format can only be inherited from the row before if there is one (row > 0)"""
         return {
             'insertDimension': {
-                'inheritFromBefore': True,
+                'inheritFromBefore': inherit_from_before,
                 'range': {
                     'sheetId': sheet_id,
                     'dimension': 'ROWS',
@@ -213,7 +340,7 @@ class GoogleSheetsAPI(_GoogleAPI):
             spreadsheetId=self._resource_id,
             range=self.__range_descriptor(range_start, range_end),
             valueRenderOption='UNFORMATTED_VALUE',
-            majorDimension=major_dimension).execute()['values']
+            majorDimension=major_dimension).execute().get('values', [])
     	
         if dims==0:
             return values[0][0]
@@ -227,31 +354,98 @@ class GoogleSheetsAPI(_GoogleAPI):
         'rows_data' should be al list of tuples where each tuple is of the form:
         (row_no (zero-based), [cell values])"""
 
-        requests = []
-        for row, data in rows_data:
-            requests.extend([
-                GoogleSheetsAPI.__insert_row_request(row, self.__sheet_id),
-                GoogleSheetsAPI.__update_row_request(row, data, self.__sheet_id)])
-        
-        self.__batch_update(requests)
+        self._apply_row_changes([], rows_data, [])
     
     def _update_rows(self, rows_data):
         """Updates the contend of the specified rows
         'rows_data' should be al list of tuples where each tuple is of the form:
         (row_no (zero-based), [cell values])"""
 
-        requests = [
-            GoogleSheetsAPI.__update_row_request(row, data, self.__sheet_id)
-            for row, data in rows_data]
-        self.__batch_update(requests)
+        self._apply_row_changes([], [], rows_data)
     
     def _delete_rows(self, rows):
         """Deletes the specified rows (zero-based)"""
 
+        self._apply_row_changes(rows, [], [])
+
+    def _apply_row_changes(self, deletes, inserts, updates):
+        """Deletes, inserts and updates rows in a single batch update
+        The changes are applied in this order, each row number has to be valid at the time of its change.
+        'deletes' should be a list of row numbers (zero-based)
+        'inserts' and 'updates' should be lists of tuples of the form:
+        (row_no (zero-based), [cell values])"""
+
         requests = [
             GoogleSheetsAPI.__delete_row_request(row, self.__sheet_id)
-            for row in rows]
-        self.__batch_update(requests)
+            for row in deletes]
+        for row, data in inserts:
+            requests.extend([
+                GoogleSheetsAPI.__insert_row_request(row, self.__sheet_id, inherit_from_before=row > 0),
+                GoogleSheetsAPI.__update_row_request(row, data, self.__sheet_id)])
+        requests.extend(
+            GoogleSheetsAPI.__update_row_request(row, data, self.__sheet_id)
+            for row, data in updates)
+
+        if requests:
+            self.__batch_update(requests)
+
+    @staticmethod
+    def _row_diff(current_rows, target_rows):
+        """Computes the row changes that turn 'current_rows' into 'target_rows'
+        Rows are identified by their first cell. Rows that keep their relative order are updated in place,
+        all other rows are deleted and inserted at their new position.
+        Returns a tuple (deletes, inserts, updates) that can be passed to _apply_row_changes"""
+
+        target_index = {}
+        for i, row in enumerate(target_rows):
+            target_index.setdefault(row[0], i)
+
+        # (current index, target index) of the rows that are in both lists
+        common = []
+        seen = set()
+        for i, row in enumerate(current_rows):
+            t = target_index.get(row[0])
+            if t is not None and row[0] not in seen:
+                seen.add(row[0])
+                common.append((i, t))
+
+        kept = {t: i for i, t in GoogleSheetsAPI.__longest_increasing(common)}
+        kept_current = set(kept.values())
+
+        # delete from the bottom, so the indices of the remaining rows do not shift
+        deletes = [i for i in reversed(range(len(current_rows))) if i not in kept_current]
+        # insert from the top, so each row is inserted at its final index
+        inserts = [(t, row) for t, row in enumerate(target_rows) if t not in kept]
+        updates = [
+            (t, target_rows[t]) for t, i in sorted(kept.items())
+            if current_rows[i] != target_rows[t]]
+
+        return deletes, inserts, updates
+
+    @staticmethod
+    def __longest_increasing(pairs):
+        """Returns the longest subsequence of 'pairs' with increasing second elements"""
+
+        tails = []
+        tail_pairs = []
+        previous = [None] * len(pairs)
+        for k, (_, t) in enumerate(pairs):
+            pos = bisect.bisect_left(tails, t)
+            if pos == len(tails):
+                tails.append(t)
+                tail_pairs.append(k)
+            else:
+                tails[pos] = t
+                tail_pairs[pos] = k
+            previous[k] = tail_pairs[pos - 1] if pos > 0 else None
+
+        result = []
+        k = tail_pairs[-1] if tail_pairs else None
+        while k is not None:
+            result.append(pairs[k])
+            k = previous[k]
+
+        return result[::-1]
 
     def __batch_update(self, requests):
         body = {'requests': requests}
@@ -279,6 +473,8 @@ class GoogleSheetsAPI(_GoogleAPI):
 def refresh_oauth_token():
     """refresh an expired installed app OAuth token"""
 
+    import google_auth_oauthlib.flow
+
     secrets_file = 'secrets.json'
 
     secrets_path_file = os.path.join(os.path.dirname(__file__), secrets_file)
@@ -0,0 +1,144 @@
+"""Incremental reading of large JSON documents
+
+Only the elements of a single array in the document are yielded, one at a time. The values
+next to the path to the array are decoded completely and dropped, so the memory use is bounded
+by the largest single value instead of the whole document."""
+
+import json
+import codecs
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+class _Reader:
+    """Character buffer over an iterable of byte chunks,
+    consumed characters are dropped when the buffer is refilled"""
+
+    def __init__(self, chunks):
+        self.__chunks = iter(chunks)
+        self.__utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """read the next chunk into the buffer
+        returns False if the input is exhausted"""
+        if self.eof:
+            return False
+
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+
+        try:
+            chunk = next(self.__chunks)
+        except StopIteration:
+            self.buffer += self.__utf8.decode(b'', final=True)
+            self.eof = True
+            return False
+
+        self.buffer += self.__utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+        return True
+
+    def peek(self):
+        """skip whitespace and return the next character ('' at the end of the input)"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def decode(self):
+        """decode the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # a number could continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            self.fill()
+
+
+def iter_items(chunks, path):
+    """Yield the elements of the array at 'path' in the JSON document read from 'chunks'
+    chunks -> iterable of bytes or strings
+    path -> tuple of object keys leading to the array
+
+    Raises KeyError if the path is not in the document, TypeError if the value at
+    the path is neither an array nor null, json.JSONDecodeError for invalid JSON and
+    UnicodeDecodeError for invalid UTF-8"""
+
+    reader = _Reader(chunks)
+    path = tuple(path)
+    found = yield from __walk(reader, (), path)
+    if not found:
+        raise KeyError('.'.join(path))
+
+
+def __walk(reader, current, path):
+    """walk the value at the current position
+    returns True if the array at 'path' was found in the value"""
+
+    if current == path:
+        char = reader.peek()
+        if char == '[':
+            reader.pos += 1
+            if reader.peek() == ']':
+                reader.pos += 1
+                return True
+
+            while True:
+                yield reader.decode()
+                if reader.peek() == ',':
+                    reader.pos += 1
+                    continue
+
+                reader.expect(']')
+                return True
+
+        if reader.decode() is not None:
+            raise TypeError(f"{'.'.join(path)} is not an array")
+
+        return True
+
+    if reader.peek() != '{':
+        reader.decode()
+        return False
+
+    reader.pos += 1
+    found = False
+    if reader.peek() == '}':
+        reader.pos += 1
+        return found
+
+    while True:
+        key = reader.decode()
+        reader.expect(':')
+        if not found and path[len(current)] == key:
+            found = yield from __walk(reader, (*current, key), path)
+        else:
+            reader.decode()
+
+        if reader.peek() == ',':
+            reader.pos += 1
+            continue
+
+        reader.expect('}')
+        return found
@@ -0,0 +1,126 @@
+"""Lookup tables for the arenas and the scouters
+
+The tables are built once from the config (SCHEDULE_ARENAS, EMAILS) and the learned arenas
+file and kept as an immutable snapshot. refresh() reloads the config file if it was changed
+and replaces the snapshot with a single assignment, so readers always see complete tables.
+
+Arena names of the DBB schedule (matchInfo.spielfeld) that are not in the config are learned,
+the names in the config take precedence. The learned arenas are written to the arenas file
+when a sync is applied, planning a sync writes nothing."""
+
+import os
+import sys
+import json
+import logging
+import threading
+from ..config import config, reload_config
+
+__lock = threading.Lock()
+__tables = None
+
+
+class Tables:
+    """Immutable snapshot of the lookup tables, all names and emails are interned"""
+
+    def __init__(self, arenas, learned_arenas, emails):
+        """arenas -> arena id (string) -> name from the config
+        learned_arenas -> arena id (string) -> name from the DBB schedule
+        emails -> scouter name -> email"""
+        self.arenas = {sys.intern(k): sys.intern(v) for k, v in arenas.items()}
+        self.learned_arenas = {sys.intern(k): sys.intern(v) for k, v in learned_arenas.items()}
+        self.emails = {sys.intern(k): sys.intern(v) for k, v in emails.items()}
+        self.names = {v: k for k, v in self.emails.items()}
+        self.scouters = sorted(self.emails)
+
+    def arena(self, arena_id):
+        """Returns the name of the arena or None if it is unknown"""
+        arena_id = str(arena_id)
+        return self.arenas.get(arena_id) or self.learned_arenas.get(arena_id)
+
+
+def _arenas_file_name():
+    return config.get('COMMON', 'arenas_file', fallback='arenas.json')
+
+
+def _read_learned_arenas():
+    try:
+        with open(_arenas_file_name(), encoding='utf8') as arenas_file:
+            return json.load(arenas_file)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def _build():
+    return Tables(
+        dict(config.items('SCHEDULE_ARENAS')) if config.has_section('SCHEDULE_ARENAS') else {},
+        _read_learned_arenas(),
+        dict(config.items('EMAILS')) if config.has_section('EMAILS') else {})
+
+
+def tables():
+    """Returns the current lookup tables, they are built on first use"""
+
+    global __tables
+    current = __tables
+    if current is None:
+        with __lock:
+            if __tables is None:
+                __tables = _build()
+            current = __tables
+
+    return current
+
+
+def refresh():
+    """Reload the config file if it was changed and rebuild the tables
+    Returns the current lookup tables"""
+
+    global __tables
+    with __lock:
+        if reload_config() or __tables is None:
+            __tables = _build()
+            logging.info(
+                'Lookup tables loaded',
+                extra={'data': {
+                    'arenas': len(__tables.arenas),
+                    'learned_arenas': len(__tables.learned_arenas),
+                    'scouters': len(__tables.scouters)}})
+
+        return __tables
+
+
+def learn_arena(arena_id, name):
+    """Add the arena name from the DBB schedule to the learned arenas
+    Returns the name of the arena, the name from the config if it is configured"""
+
+    global __tables
+    current = tables()
+    arena_id = str(arena_id)
+    if arena_id in current.arenas:
+        return current.arenas[arena_id]
+
+    if not name or current.learned_arenas.get(arena_id) == name:
+        return current.learned_arenas.get(arena_id) or name
+
+    with __lock:
+        learned_arenas = dict(__tables.learned_arenas, **{arena_id: name})
+        __tables = Tables(__tables.arenas, learned_arenas, __tables.emails)
+        current = __tables
+
+    logging.info(f"Learned arena name from schedule: {arena_id} = {name}")
+    return current.learned_arenas[arena_id]
+
+
+def store_learned_arenas():
+    """Write the learned arenas to the arenas file if they have changed"""
+
+    learned_arenas = tables().learned_arenas
+    if _read_learned_arenas() == learned_arenas:
+        return
+
+    file_name = _arenas_file_name()
+    tmp_file_name = f"{file_name}.tmp"
+    with open(tmp_file_name, 'w', encoding='utf8') as arenas_file:
+        json.dump(dict(sorted(learned_arenas.items())), arenas_file, ensure_ascii=False, indent=1)
+
+    os.replace(tmp_file_name, file_name)
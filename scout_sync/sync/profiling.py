@@ -0,0 +1,107 @@
+"""Profiling of sync runs with cProfile and tracemalloc
+
+Each profiled run writes a `.prof` file (loadable with pstats or snakeviz) and, if memory
+tracing is enabled, a `.tracemalloc` snapshot (loadable with tracemalloc.Snapshot.load)
+to the profile directory. Only the files of the last runs are kept."""
+
+import os
+import re
+import time
+import logging
+import itertools
+import threading
+import cProfile
+import tracemalloc
+from .sync import sync
+from ..config import config
+
+__FILE_PATTERN = re.compile(r'^sync-\d{8}T\d{6}(-\d+-\d+)?-\w+\.(prof|tracemalloc)$')
+
+# cProfile and tracemalloc are process-wide, only one run is profiled at a time
+__profile_lock = threading.Lock()
+__run_numbers = itertools.count(1)
+
+
+def profile_run(label, func, *args, profile_dir='profiles', keep=10, memory=False, **kwargs):
+    """Run func(*args, **kwargs) with cProfile and optionally tracemalloc
+    The profile files are named 'sync-<timestamp>-<process id>-<run number>-<label>' and only the files
+    of the last 'keep' runs are kept. While another run is profiled, func runs without profiling."""
+
+    if not __profile_lock.acquire(blocking=False):
+        logging.info(f"Another sync is being profiled, running {label} without profiling")
+        return func(*args, **kwargs)
+
+    try:
+        os.makedirs(profile_dir, exist_ok=True)
+        file_base = os.path.join(
+            profile_dir,
+            f"sync-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(__run_numbers)}-{label}")
+
+        trace_memory = memory and not tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.start()
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+
+        finally:
+            profiler.dump_stats(f"{file_base}.prof")
+            if trace_memory:
+                tracemalloc.take_snapshot().dump(f"{file_base}.tracemalloc")
+                tracemalloc.stop()
+
+            logging.info(f"Profile written to {file_base}.prof")
+            remove_old_profiles(profile_dir, keep)
+
+    finally:
+        __profile_lock.release()
+
+
+def list_profiles(profile_dir):
+    """Returns a list of (file name, size, modification time) of the profile files, newest first"""
+
+    try:
+        file_names = [f for f in os.listdir(profile_dir) if __FILE_PATTERN.match(f)]
+    except FileNotFoundError:
+        return []
+
+    profiles = []
+    for file_name in file_names:
+        stat = os.stat(os.path.join(profile_dir, file_name))
+        profiles.append((file_name, stat.st_size, stat.st_mtime))
+
+    return sorted(profiles, key=lambda p: (p[2], p[0]), reverse=True)
+
+
+def is_profile_file(file_name):
+    return __FILE_PATTERN.match(file_name) is not None
+
+
+def remove_old_profiles(profile_dir, keep):
+    """Delete the profile files of all but the last 'keep' runs"""
+
+    # list_profiles() is ordered newest first
+    runs = list(dict.fromkeys(os.path.splitext(f)[0] for f, _, _ in list_profiles(profile_dir)))
+    for run in runs[keep:]:
+        for extension in ('.prof', '.tracemalloc'):
+            try:
+                os.remove(os.path.join(profile_dir, run + extension))
+            except FileNotFoundError:
+                pass
+
+
+def sync_job(source):
+    """Run a sync, profiled if enabled in the PROFILING config section
+    Used for the scheduled and requested syncs of the app and the sync worker"""
+
+    if not config.getboolean('PROFILING', 'enabled', fallback=False):
+        return sync(source)
+
+    return profile_run(
+        source,
+        sync,
+        source,
+        profile_dir=config.get('PROFILING', 'profile_dir'),
+        keep=config.getint('PROFILING', 'keep'),
+        memory=config.getboolean('PROFILING', 'memory'))
@@ -1,29 +1,49 @@
+import os
+import re
+import gzip
 import logging
-import requests
-import arrow
 import json
 import time
-from .google_api import GoogleCalendarAPI
+import heapq
+import itertools
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from datetime import timedelta
+from . import dates, json_stream, lookup, transport
+from .google_api import GoogleCalendarAPI, GoogleSheetsAPI
 from ..config import config
 
-logging.basicConfig(
-    filename=config.get('COMMON', 'log_file'),
-    format='%(asctime)s %(levelname)s: %(message)s',
-    datefmt='%Y-%m-%dT%H:%M:%S',
-    level=logging.INFO)
+EVENT_DURATION = timedelta(hours=2)
 
-logging.getLogger('googleapiclient').setLevel(logging.ERROR)
+# attempts to store the events if the cache is changed at the same time
+__STORE_ATTEMPTS = 3
 
-TIMEZONE = config.get('COMMON', 'timezone')
-SIMULATE = config.getboolean('COMMON', 'simulate')
+
+def _timezone():
+    return config.get('COMMON', 'timezone')
+
+def _simulate():
+    return config.getboolean('COMMON', 'simulate')
+
+def _season_start():
+    """(month, day) of the first day of a season"""
+    month, day = config.get('COMMON', 'season_start', fallback='07-01').split('-')
+    return int(month), int(day)
+
+def local_now():
+    """current time in the timezone of the config"""
+    return dates.now(_timezone())
+
+def current_season_start(now):
+    """start of the season that contains 'now'"""
+    return dates.season_start(now, *_season_start())
 
 
 class Event:
     """Manages conversion between different event representation formats (DBB schedule, Google Calendar, JSON)"""
 
-    __emails = {k: v for k, v in config.items('EMAILS')}
-    __names = {v: k for k, v in config.items('EMAILS')}
-
     def __init__(
             self, id, datetime,
             location=None,
@@ -56,20 +76,22 @@ class Event:
         if schedule_info['match_id'] is None and schedule_info['match_id'] is None:
             schedule_info = None
 
+        scouter_names = lookup.tables().names
         scouter_list = []
         for a in event.get('attendees', []):
             if a['responseStatus'] == 'declined':
                 continue
 
             try:
-                scouter_list.append(cls.__names[a['email']])
+                scouter_list.append(scouter_names[a['email']])
             except KeyError:
                 logging.warning(
-                    f"Unknown email in calendar event at {event['start'].get('dateTime') or event['start'].get('date')}: {a['email']}")
+                    f"Unknown email in calendar events: {a['email']}",
+                    extra={'data': {'start': event['start'].get('dateTime') or event['start'].get('date')}})
 
         e = cls(
             id = event_id,
-            datetime = arrow.get(event['start'].get('dateTime') or event['start'].get('date')),
+            datetime = dates.parse_iso(event['start'].get('dateTime') or event['start'].get('date')),
             location = event.get('location', None),
             league = event.get('summary', '').replace('Scouting ', '') or None,
             opponent = event.get('description', None),
@@ -82,16 +104,17 @@ class Event:
     def from_DBB_schedule(cls, event, league_name):
         """Create an event from a JSON object (DBB schedule)"""
         try:
-            datetime = arrow.get(f"{event['kickoffDate']}T{event['kickoffTime']}", tzinfo=TIMEZONE)
+            datetime = dates.parse_local(f"{event['kickoffDate']}T{event['kickoffTime']}", _timezone())
         except:
-            datetime = arrow.get(2147483648, tzinfo=TIMEZONE)
+            datetime = dates.invalid_date(_timezone())
         
         try:
-            location_id = event['matchInfo']['spielfeld']['id']
-            location = ScheduleHandler.arenas.get(str(location_id))
+            arena = event['matchInfo']['spielfeld']
+            location = lookup.learn_arena(arena['id'], arena.get('bezeichnung'))
             if location is None:
-                logging.info(f"Event at {datetime}: Unknown arena ID in Schedule: {location_id}")
-                location = event['matchInfo']['spielfeld']['bezeichnung']
+                logging.warning(
+                    f"Unknown arena ID in schedule: {arena['id']}",
+                    extra={'data': {'start': str(datetime)}})
         except:
             location = None
 
@@ -115,10 +138,15 @@ class Event:
     @classmethod
     def from_json(cls, event):
         """create an event from a json object"""
+        value = event.get('datetime')
         try:
-            datetime = arrow.get(event.get('datetime'), tzinfo=TIMEZONE)
+            if isinstance(value, (int, float)):
+                # timestamp in milliseconds from the webpage
+                datetime = dates.from_timestamp(value, _timezone())
+            else:
+                datetime = dates.parse_local(value, _timezone())
         except:
-            datetime = arrow.get(2147483648, tzinfo=TIMEZONE)
+            datetime = dates.invalid_date(_timezone())
         e = cls(
             id = str(event['id']),
             datetime = datetime,
@@ -142,11 +170,11 @@ class Event:
             
         event['start'] = {
             'dateTime': self.datetime.isoformat(),
-            'timeZone': TIMEZONE
+            'timeZone': _timezone()
         }
         event['end'] = {
-            'dateTime': self.datetime.shift(hours=2).isoformat(),
-            'timeZone': TIMEZONE
+            'dateTime': (self.datetime + EVENT_DURATION).isoformat(),
+            'timeZone': _timezone()
         }
 
         event['location'] = self.location
@@ -154,11 +182,14 @@ class Event:
         event['description'] = self.opponent
 
         if self.scouters is not None:
+            scouter_emails = lookup.tables().emails
             event['attendees'] = []
             for scouter_name in self.scouters:
-                email = self.__emails.get(scouter_name)
+                email = scouter_emails.get(scouter_name)
                 if email is None:
-                    logging.warning(f"Unknown scouter name in event at {self.datetime}: {scouter_name}")
+                    logging.warning(
+                        f"Unknown scouter name in events: {scouter_name}",
+                        extra={'data': {'start': str(self.datetime)}})
                     
                 if email not in [None, '']:
                     event['attendees'].append({
@@ -180,19 +211,29 @@ class Event:
         """return a json representation of the event"""
         return {
             'id': self.id,
-            'datetime': self.datetime.format() if self.datetime else None,
+            'datetime': dates.format_json(self.datetime) if self.datetime else None,
             'location': self.location,
             'league': self.league,
             'opponent': self.opponent,
             'scouters': self.scouters or [],
             'schedule_info': self.schedule_info}
 
+    def as_sheet_row(self):
+        """return a representation of the event as a row of cell values for the sheet mirror"""
+        return [
+            self.id,
+            round(dates.to_serial(self.datetime), 8) if self.datetime else '',
+            self.location or '',
+            self.league or '',
+            self.opponent or '',
+            ', '.join(self.scouters or [])]
+
     def __str__(self):
         info_list = (
             (i or '')
             for i in (
                 str(self.id),
-                self.datetime.format() if self.datetime else None,
+                dates.format_json(self.datetime) if self.datetime else None,
                 self.location,
                 self.league,
                 self.opponent,
@@ -219,9 +260,10 @@ class Event:
 class CalendarHandler(GoogleCalendarAPI):
     """Manages the communication with the Google Calendar API"""
 
-    def __init__(self, calendar_id):
-        super().__init__(calendar_id, TIMEZONE, SIMULATE)
+    def __init__(self, calendar_id, now=None):
+        super().__init__(calendar_id, _timezone(), _simulate(), now)
         self.__ids = None
+        self.__etags = {}
 
     def connect(self):
         try:
@@ -236,81 +278,294 @@ class CalendarHandler(GoogleCalendarAPI):
         logging.info(f"Connected to calendar: {self._resource_id}")
         return True
 
-    def add_events(self, events):
-        if not self._service:
-            return
+    def add_event(self, ev):
+        """Insert the event into the calendar
+        Returns whether the event was written"""
+        if not ev.datetime:
+            logging.warning(f"Can not add event to calendar {ev}: event has no date")
+            return False
 
-        for ev in events:
-            if not ev.datetime:
-                logging.warning(f"Can not add event to calendar {ev}: event has no date")
-                continue
+        self._insert_event(ev.as_calendar_event())
+        logging.debug(
+            "Added event to calendar: %s", ev,
+            extra={'data': {'phase': 'add', 'event': ev.id}})
+        return True
 
-            self._insert_event(ev.as_calendar_event())
-            logging.info(
-                f"{'(SIMULATED) ' if SIMULATE else ''}Added event to calendar:\n\t\t{ev}")
+    def update_event(self, ev):
+        """Patch the fields of the calendar event that differ from the event
+        Returns whether the event was written"""
+        cal_id = self.__ids.get(ev.id)
+        if cal_id is None:
+            raise ValueError(f"Can not update event {ev.id}: event is not in calendar!")
 
-    def update_events(self, events):
-        if not self._service:
-            return
+        cal_ev = self._get_single_event(cal_id)
+        patch, notify = self._event_patch(cal_ev, ev.as_calendar_event())
+        if not patch:
+            return False
 
-        for ev in events:
-            cal_id = self.__ids.get(ev.id)
-            if cal_id is None:
-                raise ValueError(f"Can not update event {ev.id}: event is not in calendar!")
-            
-            cal_ev = self._get_single_event(cal_id)
-            old_ev = Event.from_calendar_event(cal_ev)
+        self._patch_event(cal_id, patch, cal_ev, notify)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(
+                "Updated event in calendar: - %s + %s", Event.from_calendar_event(cal_ev), ev,
+                extra={'data': {'phase': 'update', 'event': ev.id, 'fields': sorted(patch), 'notify': notify}})
+        return True
 
-            self._update_event(cal_id, ev.as_calendar_event(), cal_ev)
-            logging.info(
-                f"{'(SIMULATED) ' if SIMULATE else ''}Updated event in calendar:\n\t-\t{old_ev}\n\t+\t{ev}")
+    def delete_event(self, ev):
+        """Delete the event from the calendar
+        Returns whether the event was written"""
+        cal_id = self.__ids.get(ev.id)
+        if cal_id is None:
+            raise ValueError(f"Can not delete event {ev.id}: event is not in calendar!")
+
+        cal_ev = self._get_single_event(cal_id)
+        self._delete_event(cal_id, cal_ev)
+        logging.debug(
+            "Deleted event in calendar: %s", ev,
+            extra={'data': {'phase': 'delete', 'event': ev.id}})
+        return True
 
-    def delete_events(self, events):
+    def write_events(self, queue, deadline=None):
+        """Apply the writes of the WriteQueue in its order until it is empty or the deadline (timestamp) has passed
+        the remaining writes stay in the queue"""
         if not self._service:
             return
 
-        for ev in events:
-            cal_id = self.__ids.get(ev.id)
-            if cal_id is None:
-                raise ValueError(f"Can not delete event {ev.id}: event is not in calendar!")
-            
-            cal_ev = self._get_single_event(cal_id)
-            old_ev = Event.from_calendar_event(cal_ev)
-
-            self._delete_event(cal_id, cal_ev)
-            logging.info(
-                f"{'(SIMULATED) ' if SIMULATE else ''}Deleted event in calendar:\n\t\t{old_ev}")
-
-    def list_events(self):
+        writes = {'add': self.add_event, 'update': self.update_event, 'delete': self.delete_event}
+        written = dict.fromkeys(writes, 0)
+        while queue and (deadline is None or time.time() < deadline):
+            phase, ev = queue.pop()
+            if writes[phase](ev):
+                written[phase] += 1
+
+        for phase, verb in (('add', 'Added'), ('update', 'Updated'), ('delete', 'Deleted')):
+            self.__log_phase(phase, verb, written[phase])
+
+    def __log_phase(self, phase, verb, count):
+        """log one summary record for a calendar write phase"""
+        simulated = _simulate()
+        logging.info(
+            f"{'(SIMULATED) ' if simulated else ''}{verb} {count} events in calendar",
+            extra={'data': {'phase': phase, 'count': count, 'simulated': simulated}})
+
+    def list_events(self, time_min=None):
+        """List the calendar events that start after 'time_min'"""
         if not self._service:
             return
 
-        calendar_events = self._get_all_events()
+        calendar_events = self._get_all_events(time_min)
         self.__ids = {}
+        self.__etags = {}
         events = []
         for ce in calendar_events:
             event = Event.from_calendar_event(ce)
             
             if event is not None:
                 self.__ids[event.id] = ce['id']
+                self.__etags[event.id] = ce.get('etag')
                 events.append(event)
 
         return events
 
+    def etag(self, event_id):
+        """Returns the etag of the calendar event of the listed event or None if it is not in the calendar"""
+        return self.__etags.get(event_id)
+
+
+class WriteQueue:
+    """Priority queue of the calendar writes of a sync run, ordered by how close the events are:
+    upcoming and running events first, the nearest first, then past events, the most recent first
+    with 'skip_past' the writes of past events are dropped"""
+
+    def __init__(self, now, skip_past=False):
+        self.__now = now
+        self.__skip_past = skip_past
+        self.__heap = []
+        self.__count = itertools.count()
+        self.skipped = []
+
+    def put(self, phase, ev):
+        """phase -> 'add', 'update' or 'delete'"""
+        if ev.datetime is None:
+            # events without date can not be written, they are reported by the calendar handler
+            priority = (True, timedelta.max)
+        elif ev.datetime + EVENT_DURATION < self.__now:
+            if self.__skip_past:
+                self.skipped.append((phase, ev))
+                return
+            priority = (True, self.__now - ev.datetime)
+        else:
+            priority = (False, abs(ev.datetime - self.__now))
+
+        heapq.heappush(self.__heap, (priority, next(self.__count), phase, ev))
+
+    def pop(self):
+        """Returns the (phase, event) of the most urgent write"""
+        _, _, phase, ev = heapq.heappop(self.__heap)
+        return phase, ev
+
+    def items(self):
+        """Returns the (phase, event) of the remaining writes in their order"""
+        return [(phase, ev) for _, _, phase, ev in sorted(self.__heap)]
+
+    def __len__(self):
+        return len(self.__heap)
+
+
+class DeferredWritesHandler():
+    """Manages the file of the calendar writes of web edits that did not fit into the time budget of a run
+    the writes are merged into the plan of the next run from the schedule, which does not
+    contain the edits of the web page (see _plan())"""
+
+    def __init__(self, deferred_file_name):
+        self.__file_name = deferred_file_name
+
+    def list_writes(self):
+        """Returns the deferred writes as list of (phase, Event)"""
+        try:
+            with open(self.__file_name, encoding='utf8') as deferred_file:
+                return [(w['phase'], Event.from_json(w['event'])) for w in json.load(deferred_file)]
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return []
+
+    def update_writes(self, handled, remaining):
+        """Replace the deferred writes that a run has handled with its remaining writes
+        handled -> list of (phase, Event) that the run read, None for all deferred writes
+        remaining -> list of (phase, Event) that are deferred again
+        Writes deferred by other runs in the meantime are kept, they take precedence over the
+        remaining writes of the same events. The update is serialized with a lock file."""
+        with FileLock(f"{self.__file_name}.lock"):
+            writes = self.list_writes()
+            if handled is not None:
+                handled = [(p, ev.as_json()) for p, ev in handled]
+                writes = [(p, ev) for p, ev in writes if (p, ev.as_json()) not in handled]
+            else:
+                writes = []
+
+            kept_ids = {ev.id for _, ev in writes}
+            writes += [(p, ev) for p, ev in remaining if ev.id not in kept_ids]
+            self.__store(writes)
+
+    def __store(self, writes):
+        """no writes remove the file"""
+        if not writes:
+            try:
+                os.remove(self.__file_name)
+            except FileNotFoundError:
+                pass
+            return
+
+        tmp_file_name = f"{self.__file_name}.tmp"
+        with open(tmp_file_name, 'w', encoding='utf8') as deferred_file:
+            json.dump([{'phase': p, 'event': ev.as_json()} for p, ev in writes], deferred_file, ensure_ascii=False)
+
+        os.replace(tmp_file_name, self.__file_name)
+
+
+class SheetHandler(GoogleSheetsAPI):
+    """Mirrors the event list into a sheet of a Google Sheets spreadsheet"""
+
+    __HEADER = ['ID', 'Datum', 'Halle', 'Liga', 'Gegner', 'Scouter']
+
+    def __init__(self, spreadsheet_id, sheet_name, sheet_id):
+        super().__init__(spreadsheet_id, sheet_name, sheet_id, _timezone(), _simulate())
+
+    def connect(self):
+        try:
+            self._connect_to_service()
+
+        except Exception as e:
+            logging.error(
+                f"Connection to spreadsheet with ID {self._resource_id} failed: {e}")
+            
+            return False
+
+        logging.info(f"Connected to spreadsheet: {self._resource_id}")
+        return True
+
+    def mirror_events(self, events):
+        """Update the sheet to match the events with a single read and a single batch update
+        The first row of the sheet is the header, the events are sorted by date"""
+        if not self._service:
+            return
+
+        columns = len(SheetHandler.__HEADER)
+        rows = [SheetHandler.__normalize(r, columns) for r in self._get_range('A1', 'F', dims=2)]
+        target_rows = [
+            ev.as_sheet_row()
+            for ev in sorted(events, key=lambda e: (e.datetime is None, e.datetime, e.id))]
+
+        # a first row with event data is kept, the header is inserted above it
+        if rows and SheetHandler.__is_header(rows[0], {r[0] for r in target_rows}):
+            header, current_rows = rows[0], rows[1:]
+        else:
+            header, current_rows = None, rows
+
+        deletes, inserts, updates = self._row_diff(current_rows, target_rows)
+
+        # shift the data rows below the header
+        deletes = [row + 1 for row in deletes]
+        inserts = [(row + 1, data) for row, data in inserts]
+        updates = [(row + 1, data) for row, data in updates]
+        if header != SheetHandler.__HEADER:
+            if header is None:
+                inserts.insert(0, (0, SheetHandler.__HEADER))
+            else:
+                updates.insert(0, (0, SheetHandler.__HEADER))
+
+        self._apply_row_changes(deletes, inserts, updates)
+        simulated = _simulate()
+        logging.info(
+            f"{'(SIMULATED) ' if simulated else ''}Mirrored {len(target_rows)} events to sheet",
+            extra={'data': {
+                'phase': 'sheet',
+                'inserted': len(inserts),
+                'updated': len(updates),
+                'deleted': len(deletes),
+                'simulated': simulated}})
+
+    @staticmethod
+    def __is_header(row, event_ids):
+        """a row is taken as header unless it has a date (serial number) or the ID of an event"""
+        return not isinstance(row[1], (int, float)) and row[0] not in event_ids
+
+    @staticmethod
+    def __normalize(row, columns):
+        """pad a row read from the sheet to the column count and convert the cells to the written types"""
+        row = (row + [''] * columns)[:columns]
+        row[0] = str(row[0])
+        if isinstance(row[1], (int, float)):
+            row[1] = round(row[1], 8)
+
+        return row
+
 
 class ScheduleHandler:
     "manages downloads from the DBB game schedule database"
 
-    arenas = dict(config['SCHEDULE_ARENAS'])
-    __REQUEST_TIMEOUT = config.getint('COMMON', 'schedule_request_timeout')
+    __CHUNK_SIZE = 64 * 1024
+
+    # properties of the match info that are kept for creating the events
+    __MATCH_INFO_FIELDS = {
+        'matchId': None,
+        'matchNo': None,
+        'kickoffDate': None,
+        'kickoffTime': None,
+        'abgesagt': None,
+        'verzicht': None,
+        'ligaData': {'ligaId': None, 'verbandId': None},
+        'guestTeam': {'teamname': None},
+        'matchInfo': {'spielfeld': {'id': None, 'bezeichnung': None}}}
 
     def __init__(self, leagues):
+        self.__request_timeout = config.getint('COMMON', 'schedule_request_timeout')
         self.__schedule = []
         self.__leagues = [
             dict(zip(['league_name', 'league_id', 'team_permanent_id', 'team_season_id'], l))
             for l in leagues]
 
     def connect(self):
+        import requests
+
         api_url = 'https://www.basketball-bund.net/rest'
         schedule_url = f"{api_url}/competition/spielplan/id/{{league_id}}"
         match_info_url = f"{api_url}/match/id/{{match_id}}/matchInfo"
@@ -318,72 +573,71 @@ class ScheduleHandler:
         self.__failed_league_downloads = []
         self.__failed_match_downloads = []
 
-        with requests.Session() as s:
-            for league in self.__leagues:
-                # get the complete league schedule
-                league_name, league_id, team_permanent_id, team_season_id = league.values()
-                r = s.get(
+        # the shared session keeps the connections to the DBB server alive between the requests and runs
+        s = transport.http_session()
+        for league in self.__leagues:
+            # stream the league schedule and keep only the home matches of the team
+            league_name, league_id, team_permanent_id, team_season_id = league.values()
+            with s.get(
                     schedule_url.format(league_id=league_id),
-                    timeout=ScheduleHandler.__REQUEST_TIMEOUT)
+                    timeout=self.__request_timeout,
+                    stream=True) as r:
+                if r.status_code != 200:
+                    self.__failed_league_downloads.append(str(league_id))
+                    logging.warning(f"Can not download schedule for league {league_name} ({r.status_code}: {r.reason})")
+                    continue
+
+                try:
+                    team_matches, invalid_matches = self.__read_league_matches(
+                        r.iter_content(chunk_size=ScheduleHandler.__CHUNK_SIZE),
+                        team_permanent_id,
+                        team_season_id)
+
+                # ValueError covers invalid JSON and invalid UTF-8
+                except (ValueError, KeyError, TypeError, requests.RequestException):
+                    self.__failed_league_downloads.append(str(league_id))
+                    logging.warning(f"Can not read schedule for league {league_name}")
+                    continue
+
+            for match_id in invalid_matches:
+                if match_id is not None:
+                    self.__failed_match_downloads.append(str(match_id))
+
+                logging.warning(f"Can not read game {match_id} from league {league_name}")
+
+            # get the details for each match
+            for match_id in team_matches:
+                r = s.get(
+                    match_info_url.format(match_id=match_id),
+                    timeout=self.__request_timeout)
 
                 if r.status_code == 200:
                     try:
-                        league_schedule = r.json()
-                        if not self.__validate_league(league_schedule):
+                        match_info = r.json()
+                        if not self.__validate_match_info(match_info):
                             raise ValueError()
-
+                        
                     except (json.decoder.JSONDecodeError, ValueError):
-                        self.__failed_league_downloads.append(str(league_id))
-                        logging.warning(f"Can not read schedule for league {league_name}")
+                        self.__failed_match_downloads.append(str(match_id))
+                        logging.warning(f"Can not read game details for game {match_id} for league {league_name}")
                         continue
                 else:
-                    self.__failed_league_downloads.append(str(league_id))
-                    logging.warning(f"Can not download schedule for league {league_name} ({r.status_code}: {r.reason})")
+                    self.__failed_match_downloads.append(str(match_id))
+                    logging.warning(f"Can not download game details for game {match_id} for league {league_name} ({r.status_code}: {r.reason})")
                     continue
-                
-                team_matches = []
-                for match in league_schedule['data']['matches']:
-                    if not self.__validate_match(match):
-                        try:
-                            match_id = match['matchId']
-                        except:
-                            match_id = None
-
-                        if match_id is not None:
-                            self.__failed_match_downloads.append(str(match_id))
-
-                        logging.warning(f"Can not read game {match_id} from league {league_name}")
-                        continue
-
-                    if (
-                            (team_permanent_id and match['homeTeam']['teamPermanentId'] == team_permanent_id) or
-                            (team_season_id and match['homeTeam']['seasonTeamId'] == team_season_id)):
-                        team_matches.append(match['matchId'])
-                   
-                # get the details for each match
-                for match_id in team_matches:
-                    r = s.get(
-                        match_info_url.format(match_id=match_id),
-                        timeout=ScheduleHandler.__REQUEST_TIMEOUT)
-
-                    if r.status_code == 200:
-                        try:
-                            match_info = r.json()
-                            if not self.__validate_match_info(match_info):
-                                raise ValueError()
-                            
-                        except (json.decoder.JSONDecodeError, ValueError):
-                            self.__failed_match_downloads.append(str(match_id))
-                            logging.warning(f"Can not read game details for game {match_id} for league {league_name}")
-                            continue
-                    else:
-                        self.__failed_match_downloads.append(str(match_id))
-                        logging.warning(f"Can not download game details for game {match_id} for league {league_name} ({r.status_code}: {r.reason})")
-                        continue
-
-                    self.__schedule.append((match_info['data'], league_name))
 
-        logging.info(f"Downloaded {len(self.__schedule)} game schedules from {len(self.__leagues)} leagues")
+                self.__schedule.append((
+                    ScheduleHandler.__select(match_info['data'], ScheduleHandler.__MATCH_INFO_FIELDS),
+                    league_name))
+
+        logging.info(
+            f"Downloaded {len(self.__schedule)} game schedules from {len(self.__leagues)} leagues",
+            extra={'data': {
+                'phase': 'download',
+                'matches': len(self.__schedule),
+                'leagues': len(self.__leagues),
+                'failed_leagues': len(self.__failed_league_downloads),
+                'failed_matches': len(self.__failed_match_downloads)}})
         return True
 
     def list_events(self):
@@ -402,18 +656,38 @@ class ScheduleHandler:
             match.schedule_info['match_id'] in self.__failed_match_downloads or
             match.schedule_info['league_id'] in self.__failed_league_downloads)
 
-    def __validate_league(self, league):
-        """Check if all relevant properties of the downloaded league
-        are present and readable"""
-        try:
-            matches = league['data']['matches']
-            if matches is not None and not isinstance(matches, list):
-                raise TypeError()
-        
-        except:
-            return False
+    def __read_league_matches(self, chunks, team_permanent_id, team_season_id):
+        """Read the matches of a league schedule incrementally from the response chunks
+        Only the IDs of the home matches of the team are kept.
+        Returns a tuple of the list of home match IDs and the list of invalid match IDs"""
+        team_matches = []
+        invalid_matches = []
+        for match in json_stream.iter_items(chunks, ('data', 'matches')):
+            if not self.__validate_match(match):
+                try:
+                    match_id = match['matchId']
+                except:
+                    match_id = None
+
+                invalid_matches.append(match_id)
+                continue
 
-        return True
+            if (
+                    (team_permanent_id and match['homeTeam']['teamPermanentId'] == team_permanent_id) or
+                    (team_season_id and match['homeTeam']['seasonTeamId'] == team_season_id)):
+                team_matches.append(match['matchId'])
+
+        return team_matches, invalid_matches
+
+    @staticmethod
+    def __select(value, fields):
+        """Returns a copy of 'value' reduced to the properties in 'fields'"""
+        if fields is None or not isinstance(value, dict):
+            return value
+
+        return {
+            key: ScheduleHandler.__select(value[key], sub_fields)
+            for key, sub_fields in fields.items() if key in value}
 
     def __validate_match(self, match):
         """Check if all relevant properties of the downloaded match
@@ -455,14 +729,57 @@ class ScheduleHandler:
         return True
 
 
+class CacheConflictError(RuntimeError):
+    """The events cache was changed since it was read"""
+
+
+class FileLock:
+    """Exclusive lock on a file, shared between processes and threads (no locking without fcntl)"""
+
+    def __init__(self, file_name):
+        self.__file_name = file_name
+        self.__file = None
+
+    def __enter__(self):
+        self.__file = open(self.__file_name, 'a')
+        if fcntl is not None:
+            fcntl.flock(self.__file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is not None:
+            fcntl.flock(self.__file, fcntl.LOCK_UN)
+        self.__file.close()
+
+
 class WebCacheHandler():
+    """Manages the events cache file
+    The file contains the events and a version that is increased with every write.
+    Writes are atomic (write to a temporary file and rename) and serialized with a lock file."""
+
     def __init__(self, chache_file_name):
+        self.__file_name = chache_file_name
+        self.__version = 0
         try:
             with open(chache_file_name, encoding='utf8') as web_cache_file:
-                self.__events = json.load(web_cache_file)
+                self.__events, self.__version = WebCacheHandler.__parse(json.load(web_cache_file))
         except (FileNotFoundError, json.decoder.JSONDecodeError):
             self.__events = None
     
+    @staticmethod
+    def __parse(content):
+        """returns the events and the version of the file content"""
+        # caches written before versioning only contain the event list
+        if isinstance(content, list):
+            return content, 0
+
+        return content['events'], content['version']
+
+    @property
+    def version(self):
+        """version of the cache when it was read, 0 if there is no cache"""
+        return self.__version
+
     def list_events(self):
         if self.__events is not None:
             return [Event.from_json(e) for e in self.__events]
@@ -470,23 +787,190 @@ class WebCacheHandler():
     def json_events(self):
         return self.__events
     
-    def store_events(self, events):
-        with open(config.get('COMMON', 'web_cache_file'), 'w', encoding='utf8') as web_cache_file:
-            json.dump([e.as_json() for e in events], web_cache_file, ensure_ascii=False)
+    def store_events(self, events, expected_version=None):
+        """Write the events to the cache and return the new version
+        The cache and its version are kept if it already contains the events, so unchanged syncs
+        do not invalidate the version the edits of the web page are based on.
+        Raises a CacheConflictError if 'expected_version' is set and the cache has another version"""
+        json_events = [e.as_json() for e in events]
+        with FileLock(f"{self.__file_name}.lock"):
+            try:
+                with open(self.__file_name, encoding='utf8') as web_cache_file:
+                    current_events, current_version = WebCacheHandler.__parse(json.load(web_cache_file))
+            except (FileNotFoundError, json.decoder.JSONDecodeError):
+                current_events, current_version = None, 0
 
+            if current_events == json_events:
+                self.__events = current_events
+                self.__version = current_version
+                return current_version
 
-def sync(source):
-    """Synchronise the events from source to the calendar and web cache.
-    valid scources are 'schedule' and 'cache'"""
+            if expected_version is not None and expected_version != current_version:
+                raise CacheConflictError(
+                    f"Cache version is {current_version}, expected {expected_version}")
 
-    start_time = time.time()
-    logging.info(f"Starting sync from {source}")
+            self.__events = json_events
+            self.__version = current_version + 1
+
+            tmp_file_name = f"{self.__file_name}.tmp"
+            with open(tmp_file_name, 'w', encoding='utf8') as web_cache_file:
+                json.dump(
+                    {'version': self.__version, 'events': self.__events},
+                    web_cache_file, ensure_ascii=False)
+                web_cache_file.flush()
+                os.fsync(web_cache_file.fileno())
+
+            os.replace(tmp_file_name, self.__file_name)
+
+        return self.__version
+
+
+class ArchiveHandler():
+    """Manages the read-only, gzipped event lists of closed seasons"""
+
+    __NAME_PATTERN = re.compile(r'^events-(\d{4}-\d{2})\.json\.gz$')
+
+    def __init__(self, archive_dir):
+        self.__archive_dir = archive_dir
+
+    def seasons(self):
+        """Returns the names of the archived seasons, newest first"""
+        try:
+            file_names = os.listdir(self.__archive_dir)
+        except FileNotFoundError:
+            return []
+
+        return sorted(
+            (m.group(1) for m in map(ArchiveHandler.__NAME_PATTERN.match, file_names) if m),
+            reverse=True)
+
+    def json_events(self, season):
+        """Returns the archived events of the season in JSON format or None if the season is not archived"""
+        try:
+            with gzip.open(self.__file_name(season), 'rt', encoding='utf8') as archive_file:
+                return json.load(archive_file)
+        except FileNotFoundError:
+            return None
+
+    def archive_events(self, events, before):
+        """Write the events that start before 'before' to the archives of their seasons
+        Archives are written once, events of seasons that are already archived are dropped"""
+        month, day = _season_start()
+        seasons = {}
+        for ev in events:
+            if ev.datetime < before:
+                seasons.setdefault(dates.season_name(ev.datetime, month, day), []).append(ev)
+
+        archived = set(self.seasons())
+        for season, season_events in seasons.items():
+            if season in archived:
+                logging.warning(
+                    f"Season {season} is already archived, dropped {len(season_events)} events",
+                    extra={'data': {'events': [ev.id for ev in season_events]}})
+                continue
+
+            self.__store(season, season_events)
+            logging.info(
+                f"Archived {len(season_events)} events of season {season}",
+                extra={'data': {'phase': 'archive', 'season': season, 'count': len(season_events)}})
+
+    def __store(self, season, events):
+        os.makedirs(self.__archive_dir, exist_ok=True)
+        file_name = self.__file_name(season)
+        tmp_file_name = f"{file_name}.tmp"
+        with gzip.open(tmp_file_name, 'wt', encoding='utf8') as archive_file:
+            json.dump([e.as_json() for e in events], archive_file, ensure_ascii=False)
+
+        os.chmod(tmp_file_name, 0o444)
+        os.replace(tmp_file_name, file_name)
+
+    def __file_name(self, season):
+        return os.path.join(self.__archive_dir, f"events-{season}.json.gz")
+
+
+class SyncPlan:
+    """The calendar writes and the resulting event list of a sync
+    A plan can be stored as JSON and applied later, see plan_sync() and apply_sync_plan()"""
+
+    FORMAT_VERSION = 4
+
+    def __init__(
+            self, source, created, season_start, cache_version, cache_events, writes, events, arenas,
+            deferred_writes):
+        """cache_events -> list of Events in the web cache when planned, the base to merge later edits
+        writes -> list of (phase, Event, etag of the calendar event when planned)
+        events -> list of Events in the web cache after the sync
+        arenas -> learned arenas when planned (arena id -> name), they are stored when the plan is applied
+        deferred_writes -> list of (phase, Event) of the deferred writes merged into the plan"""
+        self.source = source
+        self.created = created
+        self.season_start = season_start
+        self.cache_version = cache_version
+        self.cache_events = cache_events
+        self.writes = writes
+        self.events = events
+        self.arenas = arenas
+        self.deferred_writes = deferred_writes
+
+    def count(self, phase):
+        return sum(1 for p, _, _ in self.writes if p == phase)
+
+    def as_json(self):
+        return {
+            'format': SyncPlan.FORMAT_VERSION,
+            'source': self.source,
+            'created': self.created.isoformat(),
+            'season_start': self.season_start.isoformat(),
+            'cache_version': self.cache_version,
+            'cache_events': [ev.as_json() for ev in self.cache_events],
+            'writes': [{'phase': p, 'event': ev.as_json(), 'etag': etag} for p, ev, etag in self.writes],
+            'events': [ev.as_json() for ev in self.events],
+            'arenas': self.arenas,
+            'deferred_writes': [{'phase': p, 'event': ev.as_json()} for p, ev in self.deferred_writes]}
+
+    @classmethod
+    def from_json(cls, plan):
+        if plan.get('format') != SyncPlan.FORMAT_VERSION:
+            raise ValueError(f"Unsupported sync plan format: {plan.get('format')}")
+
+        return cls(
+            source=plan['source'],
+            created=dates.parse_iso(plan['created']),
+            season_start=dates.parse_iso(plan['season_start']),
+            cache_version=plan['cache_version'],
+            cache_events=[Event.from_json(e) for e in plan['cache_events']],
+            writes=[(w['phase'], Event.from_json(w['event']), w['etag']) for w in plan['writes']],
+            events=[Event.from_json(e) for e in plan['events']],
+            arenas=plan['arenas'],
+            deferred_writes=[(w['phase'], Event.from_json(w['event'])) for w in plan['deferred_writes']])
+
+    def store(self, file_name):
+        with open(file_name, 'w', encoding='utf8') as plan_file:
+            json.dump(self.as_json(), plan_file, ensure_ascii=False, indent=1)
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name, encoding='utf8') as plan_file:
+            return cls.from_json(json.load(plan_file))
+
+
+def _deferred_writes_hdl():
+    return DeferredWritesHandler(config.get('CALENDAR_WRITES', 'deferred_file', fallback='calendar_writes.json'))
 
-    calendar_hdl = CalendarHandler(config.get('CALENDAR', 'id'))
+
+def _connect_calendar(now):
+    calendar_hdl = CalendarHandler(config.get('CALENDAR', 'id'), now)
     if not calendar_hdl.connect():
         raise RuntimeError('Connection to the calendar failed.')
-    
-    cache_hdl = WebCacheHandler(config.get('COMMON', 'web_cache_file'))
+
+    return calendar_hdl
+
+
+def _plan(source, now, calendar_hdl, cache_hdl):
+    """Compare the source with the calendar and return the SyncPlan"""
+
+    # only the current season is synced and cached
+    season_start = current_season_start(now)
 
     if source == 'schedule':
         schedule_leagues = [
@@ -505,8 +989,24 @@ def sync(source):
     else:
         raise ValueError(f"Invalid value for source: {source}!")
 
-    source_events = {e.id: e for e in source_hdl.list_events()}
-    calendar_events = {e.id: e for e in calendar_hdl.list_events()}
+    source_events = {e.id: e for e in source_hdl.list_events() if e.datetime >= season_start}
+    calendar_events = {e.id: e for e in calendar_hdl.list_events(season_start) if e.datetime >= season_start}
+
+    # the schedule does not contain the edits of the web page, the writes of them that were deferred
+    # by an earlier run are merged into the source (the cache contains them, so a run from it does not need them)
+    deferred_writes = _deferred_writes_hdl().list_writes() if source == 'schedule' else []
+    deferred_deletes = set()
+    for phase, ev in deferred_writes:
+        src_ev = source_events.get(ev.id)
+        if phase == 'delete':
+            if src_ev is None and ev.schedule_info is None:
+                deferred_deletes.add(ev.id)
+        elif src_ev is None:
+            # events of the web page, the schedule decides about the events from the schedule
+            if ev.schedule_info is None and ev.datetime is not None and ev.datetime >= season_start:
+                source_events[ev.id] = ev
+        elif src_ev.scouters is None:
+            src_ev.scouters = ev.scouters
 
     new_events = []
     update_events = []
@@ -535,7 +1035,8 @@ def sync(source):
     for cal_id, cal_ev in calendar_events.items():
         if cal_id not in source_events:
             # ignore events that are not part of a DBB schedule or where the download failed
-            if source == 'schedule':
+            # unless their deletion was deferred
+            if source == 'schedule' and cal_id not in deferred_deletes:
                 if cal_ev.schedule_info is None or source_hdl.failed(cal_ev):
                     if cal_ev not in all_events:    
                         all_events.append(cal_ev)
@@ -545,12 +1046,242 @@ def sync(source):
             if cal_ev not in delete_events:
                 delete_events.append(cal_ev)
 
-    calendar_hdl.add_events(new_events)
-    calendar_hdl.update_events(update_events)
-    calendar_hdl.delete_events(delete_events)
-    cache_hdl.store_events(all_events)
+    writes = [
+        (phase, ev, calendar_hdl.etag(ev.id))
+        for phase, phase_events in (('add', new_events), ('update', update_events), ('delete', delete_events))
+        for ev in phase_events]
+
+    return SyncPlan(
+        source, now, season_start, cache_hdl.version, cache_hdl.list_events() or [], writes, all_events,
+        dict(lookup.tables().learned_arenas), deferred_writes)
+
+
+def _merge_events(base_events, planned_events, current_events):
+    """Three-way merge of the event lists
+    events that were changed in the current cache since the base was read keep their current version,
+    the other events take their planned version (removed if they are not planned)"""
+
+    base = {e.id: e for e in base_events}
+    current = {e.id: e for e in current_events}
+    merged = []
+    for ev in planned_events:
+        cache_ev = current.get(ev.id)
+        if ev.id in base and (cache_ev is None or cache_ev != base[ev.id]):
+            # changed or removed in the cache
+            if cache_ev is not None:
+                merged.append(cache_ev)
+        elif ev.id not in base and cache_ev is not None:
+            # added to the cache and planned, the cache has the newer edit
+            merged.append(cache_ev)
+        else:
+            merged.append(ev)
+
+    planned = {e.id for e in planned_events}
+    for cache_ev in current_events:
+        if cache_ev.id in planned:
+            continue
+
+        base_ev = base.get(cache_ev.id)
+        if base_ev is None or base_ev != cache_ev:
+            # added or changed in the cache since the base was read
+            merged.append(cache_ev)
+
+    return merged
+
+
+def _store_merged_events(base_events, planned_events):
+    """Merge the planned events with the edits stored in the cache since 'base_events' were read
+    and store them, the merge is retried if the cache changes again"""
+
+    for attempt in range(__STORE_ATTEMPTS):
+        cache_hdl = WebCacheHandler(config.get('COMMON', 'web_cache_file'))
+        merged = _merge_events(base_events, planned_events, cache_hdl.list_events() or [])
+        try:
+            cache_hdl.store_events(merged, expected_version=cache_hdl.version)
+            return
+        except CacheConflictError as e:
+            logging.info(f"Events cache was changed during the merge, retrying: {e}")
+
+    raise CacheConflictError('Events cache was changed during every attempt to store the merged events')
+
+
+def _apply(plan, now, calendar_hdl, cache_hdl, start_time, start_stats):
+    """Write the planned changes to the calendar, the web cache, the archive and the sheet
+    start_stats -> transport.connection_stats() at the start of the run"""
+
+    # closed seasons are moved from the cache to the archive
+    ArchiveHandler(config.get('COMMON', 'archive_dir')).archive_events(
+        cache_hdl.list_events() or [], plan.season_start)
+
+    # write the most urgent changes first, writes that do not fit into the time budget of the run
+    # are stored and merged into the next run
+    write_queue = WriteQueue(
+        now, skip_past=config.get('CALENDAR_WRITES', 'past_events', fallback='last') == 'skip')
+    for phase, ev, _ in plan.writes:
+        write_queue.put(phase, ev)
+
+    # the budget starts with the first write, not with the downloads of the run
+    budget = config.getfloat('CALENDAR_WRITES', 'budget', fallback=0)
+    calendar_hdl.write_events(write_queue, time.time() + budget if budget else None)
+
+    # a run from the cache contains all web edits, it replaces the deferred writes
+    # a run from the schedule finds its own writes again, only the deferred writes of web edits it merged are kept
+    if plan.source == 'cache':
+        _deferred_writes_hdl().update_writes(None, write_queue.items())
+    else:
+        deferred_ids = {ev.id for _, ev in plan.deferred_writes}
+        _deferred_writes_hdl().update_writes(
+            plan.deferred_writes, [(phase, ev) for phase, ev in write_queue.items() if ev.id in deferred_ids])
+    if write_queue:
+        logging.warning(
+            f"Time budget of the sync exhausted, {len(write_queue)} calendar writes deferred to the next run",
+            extra={'data': {'deferred': [f"{phase} {ev.id}" for phase, ev in write_queue.items()]}})
+    if write_queue.skipped:
+        logging.info(
+            f"Skipped {len(write_queue.skipped)} calendar writes of past events",
+            extra={'data': {'skipped': [f"{phase} {ev.id}" for phase, ev in write_queue.skipped]}})
+
+    try:
+        # do not overwrite edits that were stored since the plan was made, they trigger another sync
+        cache_hdl.store_events(plan.events, expected_version=plan.cache_version)
+    except CacheConflictError as e:
+        logging.warning(f"Events cache was changed during the sync, merging the planned events: {e}")
+        _store_merged_events(plan.cache_events, plan.events)
+
+    # the arena names learned from the schedule while planning, possibly in another process,
+    # a plan only writes when it is applied
+    for arena_id, name in plan.arenas.items():
+        lookup.learn_arena(arena_id, name)
+    lookup.store_learned_arenas()
+
+    if config.get('SHEET', 'id', fallback=None):
+        sheet_hdl = SheetHandler(
+            config.get('SHEET', 'id'),
+            config.get('SHEET', 'sheet_name', fallback=None),
+            config.getint('SHEET', 'sheet_id', fallback=0))
+        if sheet_hdl.connect():
+            # the calendar and the cache are already written, a failed mirror is repaired by the next sync
+            try:
+                sheet_hdl.mirror_events(plan.events)
+            except Exception as e:
+                logging.error(f"Mirroring the events to spreadsheet {config.get('SHEET', 'id')} failed: {e}")
 
     end_time = time.time()
-    logging.info(f"Sync finished ({(end_time-start_time):.0f}s)")
+    stats = transport.connection_stats()
+    http_requests = stats['requests'] - start_stats['requests']
+    http_connections = stats['connections'] - start_stats['connections']
+    logging.info(
+        f"Sync finished ({(end_time-start_time):.0f}s)",
+        extra={'data': {
+            'phase': 'sync',
+            'source': plan.source,
+            'added': plan.count('add'),
+            'updated': plan.count('update'),
+            'deleted': plan.count('delete'),
+            'deferred': len(write_queue),
+            'skipped': len(write_queue.skipped),
+            'cached': len(plan.events),
+            'http_requests': http_requests,
+            'http_reused': http_requests - http_connections,
+            'duration': round(end_time - start_time, 3)}})
 
-    return
+
+def sync(source):
+    """Synchronise the events from source to the calendar and web cache.
+    valid scources are 'schedule' and 'cache'
+    'calendar' only reads the changed calendar events into the web cache (see calendar_watch)"""
+
+    # pick up changes of the config file since the last run
+    lookup.refresh()
+
+    if source == 'calendar':
+        from .calendar_watch import sync_changes
+        return sync_changes()
+
+    start_time = time.time()
+    start_stats = transport.connection_stats()
+    logging.info(f"Starting sync from {source}")
+
+    # the same current time is used for all decisions of the run
+    now = local_now()
+    calendar_hdl = _connect_calendar(now)
+    cache_hdl = WebCacheHandler(config.get('COMMON', 'web_cache_file'))
+
+    _apply(_plan(source, now, calendar_hdl, cache_hdl), now, calendar_hdl, cache_hdl, start_time, start_stats)
+
+
+def plan_sync(source, plan_file_name):
+    """Compare the source with the calendar like sync() and store the changes in the plan file
+    nothing is written to the calendar, the web cache or the archive"""
+
+    logging.info(f"Planning sync from {source}")
+    lookup.refresh()
+
+    now = local_now()
+    calendar_hdl = _connect_calendar(now)
+    cache_hdl = WebCacheHandler(config.get('COMMON', 'web_cache_file'))
+
+    plan = _plan(source, now, calendar_hdl, cache_hdl)
+    plan.store(plan_file_name)
+    logging.info(
+        f"Sync plan written to {plan_file_name}",
+        extra={'data': {
+            'phase': 'plan',
+            'source': source,
+            'added': plan.count('add'),
+            'updated': plan.count('update'),
+            'deleted': plan.count('delete'),
+            'cached': len(plan.events)}})
+
+    return plan
+
+
+def apply_sync_plan(plan_file_name):
+    """Execute the writes of a stored plan
+    Writes of events that changed in the calendar since the plan was made (etag differs, event
+    added or removed) are skipped. A plan from the cache is rejected if the cache has changed."""
+
+    start_time = time.time()
+    start_stats = transport.connection_stats()
+    plan = SyncPlan.load(plan_file_name)
+    logging.info(f"Applying sync plan from {plan.source} of {plan.created.isoformat()}")
+    lookup.refresh()
+
+    now = local_now()
+    calendar_hdl = _connect_calendar(now)
+    cache_hdl = WebCacheHandler(config.get('COMMON', 'web_cache_file'))
+    if plan.source == 'cache' and cache_hdl.version != plan.cache_version:
+        raise CacheConflictError(
+            f"Events cache has changed since the plan was made (version {cache_hdl.version}, planned {plan.cache_version})")
+
+    # list the calendar once to get the current etags and the calendar IDs of the events
+    calendar_events = {e.id: e for e in calendar_hdl.list_events(plan.season_start) or []}
+    fresh_writes = []
+    stale_ids = []
+    for phase, ev, etag in plan.writes:
+        current_etag = calendar_hdl.etag(ev.id)
+        if (current_etag is not None) if phase == 'add' else (current_etag != etag):
+            stale_ids.append(ev.id)
+        else:
+            fresh_writes.append((phase, ev, etag))
+
+    if stale_ids:
+        logging.warning(
+            f"Skipped {len(stale_ids)} planned writes of events that changed in the calendar",
+            extra={'data': {'stale': [f"{phase} {ev.id}" for phase, ev, _ in plan.writes if ev.id in stale_ids]}})
+
+        # the cache gets the current calendar version of the skipped events, or not the event if it is not in the calendar
+        planned_events = {ev.id: ev for ev in plan.events}
+        events = [ev for ev in plan.events if ev.id not in stale_ids]
+        for event_id in stale_ids:
+            cal_ev = calendar_events.get(event_id)
+            if cal_ev is not None:
+                if event_id in planned_events:
+                    # the calendar only returns the schedule info as strings
+                    cal_ev.schedule_info = planned_events[event_id].schedule_info
+                events.append(cal_ev)
+
+        plan.events = events
+
+    plan.writes = fresh_writes
+    _apply(plan, now, calendar_hdl, cache_hdl, start_time, start_stats)
@@ -0,0 +1,127 @@
+"""Process-wide HTTP transport for the DBB schedule and the Google APIs
+
+All requests go through one pooled requests HTTPAdapter, so connections (and their TLS sessions)
+are kept alive and reused across syncs and threads. The Google API client uses an authorized
+session on the same adapter instead of a separate httplib2 transport per service, which is not
+thread-safe. requests and google.auth are only imported when the transport is first used."""
+
+import socket
+import threading
+from ..config import config
+
+__lock = threading.Lock()
+__adapter = None
+__session = None
+
+# credentials key -> _AuthorizedHttp
+__authorized_http = {}
+
+
+def _adapter():
+    """Returns the shared HTTPAdapter, it is created on first use"""
+
+    global __adapter
+    with __lock:
+        if __adapter is None:
+            from requests.adapters import HTTPAdapter
+            from urllib3.connection import HTTPConnection
+            from urllib3.util.retry import Retry
+
+            class KeepAliveAdapter(HTTPAdapter):
+                """HTTPAdapter with TCP keep-alive on the pooled connections"""
+
+                def init_poolmanager(self, *args, **kwargs):
+                    kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+                        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+                    super().init_poolmanager(*args, **kwargs)
+
+            __adapter = KeepAliveAdapter(
+                pool_connections=config.getint('HTTP', 'pool_connections', fallback=10),
+                pool_maxsize=config.getint('HTTP', 'pool_maxsize', fallback=10),
+                # the last 5xx response is returned when the retries are exhausted,
+                # so the callers handle it like any other failed request
+                max_retries=Retry(
+                    total=config.getint('HTTP', 'retries', fallback=2),
+                    backoff_factor=0.5,
+                    status_forcelist=[502, 503, 504],
+                    allowed_methods=['GET'],
+                    raise_on_status=False))
+
+    return __adapter
+
+
+def http_session():
+    """Returns the shared requests session
+    the session must not be closed and is not used for requests that need cookies"""
+
+    global __session
+    adapter = _adapter()
+    with __lock:
+        if __session is None:
+            import requests
+
+            __session = requests.Session()
+            __session.mount('https://', adapter)
+            __session.mount('http://', adapter)
+
+    return __session
+
+
+class _AuthorizedHttp:
+    """httplib2.Http compatible wrapper around a google.auth AuthorizedSession
+    used as the 'http' of the googleapiclient services"""
+
+    def __init__(self, session, timeout):
+        self.__session = session
+        self.__timeout = timeout
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        import httplib2
+
+        r = self.__session.request(method, uri, data=body, headers=headers, timeout=self.__timeout)
+
+        # the content is already decoded by requests
+        info = {k.lower(): v for k, v in r.headers.items() if k.lower() != 'content-encoding'}
+        info.update(status=r.status_code, reason=r.reason)
+        return httplib2.Response(info), r.content
+
+
+def authorized_http(key, create_credentials):
+    """Returns the httplib2 compatible transport for the credentials
+    key -> hashable identifying the credentials, the transport is created once per key
+    create_credentials -> function that returns the credentials"""
+
+    with __lock:
+        http = __authorized_http.get(key)
+
+    if http is None:
+        from google.auth.transport.requests import AuthorizedSession
+
+        session = AuthorizedSession(create_credentials())
+        session.mount('https://', _adapter())
+        http = _AuthorizedHttp(session, config.getfloat('HTTP', 'timeout', fallback=60))
+        with __lock:
+            http = __authorized_http.setdefault(key, http)
+
+    return http
+
+
+def connection_stats():
+    """Returns the number of requests and of opened connections of the shared transport
+    the difference is the number of requests on reused connections"""
+
+    stats = {'requests': 0, 'connections': 0}
+    with __lock:
+        adapter = __adapter
+
+    if adapter is None:
+        return stats
+
+    pools = adapter.poolmanager.pools
+    for pool_key in list(pools.keys()):
+        pool = pools.get(pool_key)
+        if pool is not None:
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+
+    return stats
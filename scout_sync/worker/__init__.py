@@ -0,0 +1,4 @@
+from .sync_queue import SyncQueue
+from .worker import run
+
+__all__ = ['SyncQueue', 'run']
@@ -0,0 +1,23 @@
+"""Starts the sync worker, that runs the scheduled syncs and the syncs requested by the web app"""
+
+import os
+from .worker import run
+from ..config import config, load_config
+from ..log import setup_logging_from_config
+
+
+def _log_file():
+    """the worker logs to its own file, two processes that rotate the same file lose records
+    the default is the log file of the app with '.worker' before the extension"""
+
+    log_file = config.get('SYNC_WORKER', 'log_file', fallback='')
+    if log_file or not config.get('COMMON', 'log_file', fallback=''):
+        return log_file
+
+    root, ext = os.path.splitext(config.get('COMMON', 'log_file'))
+    return f"{root}.worker{ext}"
+
+
+load_config()
+setup_logging_from_config(config, _log_file())
+run()
@@ -0,0 +1,94 @@
+import time
+import sqlite3
+
+
+class SyncQueue:
+    """Queue of sync requests in a SQLite table, shared by the web workers and the sync worker
+    All methods open their own connection, so an instance can be used from multiple threads"""
+
+    __SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sync_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT NOT NULL,
+            requested REAL NOT NULL,
+            started REAL,
+            finished REAL,
+            error TEXT)'''
+
+    def __init__(self, db_file, timeout=10):
+        """db_file -> string path of the SQLite database file
+        timeout -> float seconds to wait for a lock on the database"""
+        self.__db_file = db_file
+        self.__timeout = timeout
+
+        with self.__connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(SyncQueue.__SCHEMA)
+
+    def __connect(self):
+        db = sqlite3.connect(self.__db_file, timeout=self.__timeout, isolation_level=None)
+        return _Connection(db)
+
+    def put(self, source):
+        """Request a sync from 'source'
+        A request is not added if an equal one is still pending"""
+        with self.__connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            pending = db.execute(
+                'SELECT id FROM sync_requests WHERE source = ? AND started IS NULL',
+                (source,)).fetchone()
+            if pending is None:
+                db.execute(
+                    'INSERT INTO sync_requests (source, requested) VALUES (?, ?)',
+                    (source, time.time()))
+            db.execute('COMMIT')
+
+    def take(self):
+        """Claim the oldest pending request
+        Returns a tuple (request id, source) or None if the queue is empty"""
+        with self.__connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            request = db.execute(
+                'SELECT id, source FROM sync_requests WHERE started IS NULL ORDER BY id LIMIT 1').fetchone()
+            if request is not None:
+                db.execute(
+                    'UPDATE sync_requests SET started = ? WHERE id = ?',
+                    (time.time(), request[0]))
+            db.execute('COMMIT')
+
+        return request
+
+    def finish(self, request_id, error=None):
+        """Mark a claimed request as finished"""
+        with self.__connect() as db:
+            db.execute(
+                'UPDATE sync_requests SET finished = ?, error = ? WHERE id = ?',
+                (time.time(), error, request_id))
+
+    def requeue_unfinished(self):
+        """Release requests that were claimed but never finished (e.g. after a crash of the worker)"""
+        with self.__connect() as db:
+            db.execute('UPDATE sync_requests SET started = NULL WHERE started IS NOT NULL AND finished IS NULL')
+
+    def purge(self, max_age):
+        """Delete finished requests older than 'max_age' seconds"""
+        with self.__connect() as db:
+            db.execute(
+                'DELETE FROM sync_requests WHERE finished IS NOT NULL AND finished < ?',
+                (time.time() - max_age,))
+
+
+class _Connection:
+    """Context manager that closes the connection on exit
+    and rolls back an open transaction on errors"""
+
+    def __init__(self, db):
+        self.__db = db
+
+    def __enter__(self):
+        return self.__db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.__db.in_transaction:
+            self.__db.rollback()
+        self.__db.close()
@@ -0,0 +1,72 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from .sync_queue import SyncQueue
+from ..config import config
+from ..sync import sync_job, calendar_watch
+
+# finished requests are kept in the queue for a week
+__PURGE_AGE = 7 * 24 * 60 * 60
+
+
+def process_queue(sync_queue):
+    """Run the requested syncs until the queue is empty"""
+
+    while (request := sync_queue.take()) is not None:
+        request_id, source = request
+        try:
+            sync_job(source)
+
+        except Exception as e:
+            logging.exception(e)
+            sync_queue.finish(request_id, error=repr(e))
+            continue
+
+        sync_queue.finish(request_id)
+
+    sync_queue.purge(__PURGE_AGE)
+
+
+def run():
+    """Run the sync worker until it is interrupted
+    The worker owns the scheduler: it runs the sync job defined in the SYNC_JOB config section,
+    renews the calendar notification channel and polls the queue for syncs requested by the web app.
+    All syncs run one after another."""
+
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    from apscheduler.executors.pool import ThreadPoolExecutor
+
+    sync_queue = SyncQueue(config.get('SYNC_WORKER', 'queue_file'))
+    sync_queue.requeue_unfinished()
+
+    scheduler = BlockingScheduler(
+        timezone=config.get('COMMON', 'timezone'),
+        executors={'default': ThreadPoolExecutor(1)},
+        job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': None})
+
+    scheduler.add_job(
+        process_queue,
+        'interval',
+        args=[sync_queue],
+        seconds=config.getfloat('SYNC_WORKER', 'poll_interval'))
+
+    if calendar_watch.watch_enabled():
+        scheduler.add_job(
+            calendar_watch.renew_watch,
+            'interval',
+            hours=1,
+            start_date=datetime.now(timezone.utc) + timedelta(seconds=5))
+
+    if 'SYNC_JOB' in config:
+        scheduler.add_job(
+            sync_job,
+            'interval',
+            kwargs={'source': 'schedule'},
+            minutes=calendar_watch.sync_job_interval(),
+            start_date=datetime.now(timezone.utc) + timedelta(seconds=10))
+
+    logging.info(f"Sync worker started, polling {config.get('SYNC_WORKER', 'queue_file')}")
+
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass